@@ -0,0 +1,351 @@
+# Local stand-in for the Qualtrics v3 endpoints used by both tools, so performance changes can be measured offline.
+# Latency, payload size, dataset size and injected 429/5xx errors are all configurable
+import csv
+import io
+import json
+import random
+import re
+import threading
+import time
+import zipfile
+from zoneinfo import ZoneInfo
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# tickets returned per Search Tickets page, same as the real API
+PAGE_SIZE = 50
+# survey the validator's tickets belong to, and the prefix of the copy tool's source surveys
+VALIDATOR_SURVEY_ID = "SV_benchValidator"
+COPY_SURVEY_PREFIX = "SV_benchCopy"
+
+class MockConfig:
+    """ settings for one mock server run
+
+    Attributes:
+        tickets -- number of closed tickets in the validator's search window
+        surveys -- number of source surveys available to the copy tool
+        responses -- responses in each copy survey's export
+        payloadBytes -- padding added to every ticket, response, QSF and export row
+        latency -- seconds added to every request (plus up to latencyJitter more)
+        latencyJitter -- extra random latency per request
+        errorRate -- fraction of requests answered with one of errorStatuses instead
+        errorStatuses -- statuses used for injected errors (429s carry Retry-After: 0)
+        mismatchRate -- fraction of tickets whose response has a different Ticket_Status
+        progressPolls -- progress checks an export/import reports in progress before completing
+        windowDays -- how far back the tickets' closedAt dates go
+        seed -- random seed so runs are repeatable
+    """
+    def __init__(self, tickets=1000, surveys=10, responses=1000, payloadBytes=200, latency=0.01, latencyJitter=0.0,
+                 errorRate=0.0, errorStatuses=(429, 503), mismatchRate=0.05, progressPolls=2, windowDays=7, seed=1):
+        self.tickets = tickets
+        self.surveys = surveys
+        self.responses = responses
+        self.payloadBytes = payloadBytes
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.errorRate = errorRate
+        self.errorStatuses = tuple(errorStatuses)
+        self.mismatchRate = mismatchRate
+        self.progressPolls = progressPolls
+        self.windowDays = windowDays
+        self.seed = seed
+
+# transform ISO date object into the API's string format
+def iso_string(date_obj):
+    return date_obj.isoformat(timespec='milliseconds') + "Z"
+
+class MockDataset:
+    """ the tickets, responses and surveys served by the mock, generated up front from a MockConfig
+
+    Attributes:
+        windowStart -- lastRunDate to put in the validator's config files (start of the tickets' closedAt range)
+        tickets -- ticket key -> ticket result object, in closedAt order
+        responses -- responseId -> response values for the validator's survey
+        progress -- progressId -> polls left and result for running exports/imports
+        exports -- fileId -> survey and format of a started export
+    """
+    def __init__(self, config):
+        self.config = config
+        rng = random.Random(config.seed)
+        now = datetime.utcnow().replace(microsecond=0)
+        window_start = now - timedelta(days=config.windowDays)
+        self.windowStart = iso_string(window_start)
+        padding = "x" * config.payloadBytes
+        window_seconds = config.windowDays * 86400
+
+        closed_dates = sorted(window_start + timedelta(seconds=rng.uniform(1, window_seconds - 1))
+                              for i in range(config.tickets))
+        self.tickets = {}
+        self.responses = {}
+        for i, closed_at in enumerate(closed_dates):
+            key = "TKT-{n:07d}".format(n=i)
+            response_id = "R_bench{n:010d}".format(n=i)
+            ticket = {
+                "key": key,
+                "name": "Qualtrics benchmark ticket",
+                "status": 2,
+                "responseId": response_id,
+                "sourceId": VALIDATOR_SURVEY_ID,
+                "createdAt": iso_string(closed_at - timedelta(hours=1)),
+                "closedAt": iso_string(closed_at),
+                "updatedAt": iso_string(closed_at),
+                "description": padding
+            }
+            self.tickets[key] = ticket
+            self.responses[response_id] = {
+                "Ticket_Status": "Open" if rng.random() < config.mismatchRate else "Closed",
+                "Ticket_CreatedDate": ticket['createdAt'],
+                "Ticket_ClosedDate": ticket['closedAt'],
+                "Ticket_Key": key,
+                "Padding": padding
+            }
+        self.progress = {}
+        self.exports = {}
+        self.progressLock = threading.Lock()
+        self.nextId = 0
+
+    # a new unique ID with the given prefix
+    def new_id(self, prefix):
+        with self.progressLock:
+            self.nextId += 1
+            return "{prefix}{n:08d}".format(prefix=prefix, n=self.nextId)
+
+    # tickets matching a Search Tickets query (only closedAt gt/lt children are applied)
+    def search(self, body):
+        children = body.get('query', {}).get('children', [])
+        matches = list(self.tickets.values())
+        for child in children:
+            if child.get('queryType') != "closedAt":
+                continue
+            if child.get('comparison') == "gt":
+                matches = [tkt for tkt in matches if tkt['closedAt'] > child['value']]
+            elif child.get('comparison') == "lt":
+                matches = [tkt for tkt in matches if tkt['closedAt'] < child['value']]
+        return matches
+
+    # the survey definition (QSF) for a copy survey
+    def survey_definition(self, survey_id):
+        return {
+            "SurveyEntry": {"SurveyID": survey_id, "SurveyName": "Benchmark " + survey_id},
+            "SurveyElements": [{"Element": "PAD", "Payload": "x" * self.config.payloadBytes}]
+        }
+
+    # the exported responses CSV (with the 3 header rows of a labelled export) for a copy survey. Dates are written
+    # in time_zone, and with start_date (ISO 8601 UTC) set only responses recorded on or after it are included, the
+    # boundary second too, like the real API
+    def export_csv(self, survey_id, start_date=None, time_zone="UTC"):
+        output = io.StringIO()
+        writer = csv.writer(output)
+        columns = ["StartDate", "EndDate", "Status", "Duration (in seconds)", "Finished", "RecordedDate",
+                   "ResponseId", "Q1", "Padding"]
+        writer.writerow(columns)
+        writer.writerow(["Start Date", "End Date", "Response Type", "Duration (in seconds)", "Finished",
+                         "Recorded Date", "Response ID", "How was it?", "Padding"])
+        writer.writerow(['{"ImportId":"' + column + '"}' for column in columns])
+        start = datetime(2021, 1, 1)
+        zone = ZoneInfo(time_zone)
+        since = None
+        if start_date:
+            since = datetime.fromisoformat(start_date.replace("Z", "+00:00")).replace(microsecond=0)
+        for i in range(self.config.responses):
+            recorded = start + timedelta(minutes=i)
+            if since is not None and (recorded + timedelta(minutes=2)).replace(tzinfo=zone) < since:
+                continue
+            writer.writerow([str(recorded), str(recorded + timedelta(minutes=2)), "IP Address", 120, "True",
+                             str(recorded + timedelta(minutes=2)), "R_{s}{n:08d}".format(s=survey_id[-4:], n=i),
+                             "Good", "x" * self.config.payloadBytes])
+        return output.getvalue()
+
+    # the exported responses for the validator's survey in the JSON export format
+    def export_json(self):
+        return json.dumps({"responses": [{"responseId": response_id, "values": values}
+                                         for response_id, values in self.responses.items()]})
+
+    # start a long-running job, complete after progressPolls checks with the given result fields
+    def start_job(self, prefix, result):
+        progress_id = self.new_id(prefix)
+        with self.progressLock:
+            self.progress[progress_id] = {"pollsLeft": self.config.progressPolls, "result": result}
+        return progress_id
+
+    # progress check on a job: inProgress with a rising percentComplete, then complete
+    def check_job(self, progress_id):
+        with self.progressLock:
+            job = self.progress.get(progress_id)
+            if job is None:
+                return None
+            if job['pollsLeft'] > 0:
+                job['pollsLeft'] -= 1
+                done = self.config.progressPolls - job['pollsLeft']
+                return {"status": "inProgress", "percentComplete": round(100.0 * done / (self.config.progressPolls + 1))}
+            result = dict(job['result'])
+        result.update({"status": "complete", "percentComplete": 100.0})
+        return result
+
+# a successful API envelope
+def ok(result):
+    return {"result": result, "meta": {"httpStatus": "200 - OK", "requestId": "bench"}}
+
+class MockHandler(BaseHTTPRequestHandler):
+    """ request handler for the mock Qualtrics API, serves the server's dataset """
+    protocol_version = "HTTP/1.1"
+
+    # keep the benchmark output readable
+    def log_message(self, format, *args):
+        return
+
+    # request body, handling both Content-Length and chunked uploads
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = io.BytesIO()
+            while True:
+                size = int(self.rfile.readline().strip().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                body.write(self.rfile.read(size))
+                self.rfile.readline()
+            return body.getvalue()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def send_body(self, status, body, content_type="application/json", headers=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data))
+
+    # simulated latency and injected throttling/server errors; returns True if the request was answered already
+    def simulate(self):
+        config = self.server.dataset.config
+        time.sleep(config.latency + random.uniform(0, config.latencyJitter))
+        if config.errorRate and random.random() < config.errorRate:
+            status = random.choice(config.errorStatuses)
+            headers = {"Retry-After": "0"} if status == 429 else {}
+            self.send_body(status, json.dumps({"meta": {"httpStatus": "{s} - Injected".format(s=status),
+                                                        "error": {"errorMessage": "injected"}}}),
+                           headers=headers)
+            return True
+        return False
+
+    def do_GET(self):
+        self.route("GET", b"")
+
+    def do_POST(self):
+        self.route("POST", self.read_body())
+
+    def route(self, method, body):
+        if self.simulate():
+            return
+        dataset = self.server.dataset
+        url = urlparse(self.path)
+        path = url.path.split("/API/v3/", 1)[-1].strip("/")
+        query = parse_qs(url.query)
+
+        if method == "POST" and path == "tickets/search":
+            matches = dataset.search(json.loads(body or b"{}"))
+            offset = int(query.get("offset", ["0"])[0])
+            next_href = None
+            if offset + PAGE_SIZE < len(matches):
+                next_href = "http://{host}/API/v3/tickets/search?offset={n}".format(
+                    host=self.headers.get("Host"), n=offset + PAGE_SIZE)
+            self.send_json(200, ok({"elements": matches[offset:offset + PAGE_SIZE],
+                                    "links": {"next": {"href": next_href}}}))
+            return
+
+        match = re.fullmatch(r"tickets/([^/]+)", path)
+        if method == "GET" and match:
+            ticket = dataset.tickets.get(match.group(1))
+            if ticket is None:
+                self.send_json(404, {"meta": {"httpStatus": "404 - Not Found", "error": {"errorMessage": "no ticket"}}})
+                return
+            self.send_json(200, ok(ticket))
+            return
+
+        match = re.fullmatch(r"surveys/([^/]+)/responses/([^/]+)", path)
+        if method == "GET" and match:
+            values = dataset.responses.get(match.group(2))
+            if values is None:
+                self.send_json(404, {"meta": {"httpStatus": "404 - Not Found", "error": {"errorMessage": "no response"}}})
+                return
+            self.send_json(200, ok({"responseId": match.group(2), "values": values}))
+            return
+
+        match = re.fullmatch(r"survey-definitions/([^/]+)", path)
+        if method == "GET" and match:
+            self.send_json(200, ok(dataset.survey_definition(match.group(1))))
+            return
+
+        match = re.fullmatch(r"surveys/([^/]+)", path)
+        if method == "GET" and match:
+            self.send_json(200, ok({"id": match.group(1), "name": "Benchmark " + match.group(1),
+                                    "lastModifiedDate": "2021-01-01T00:00:00Z"}))
+            return
+
+        if method == "POST" and path == "surveys":
+            self.send_json(200, ok({"id": dataset.new_id("SV_benchDest")}))
+            return
+
+        match = re.fullmatch(r"surveys/([^/]+)/export-responses", path)
+        if method == "POST" and match:
+            request = json.loads(body or b"{}")
+            file_id = dataset.new_id("FILE_")
+            progress_id = dataset.start_job("ES_", {"fileId": file_id})
+            with dataset.progressLock:
+                dataset.exports[file_id] = {"survey": match.group(1), "format": request.get("format", "csv"),
+                                            "startDate": request.get("startDate"),
+                                            "timeZone": request.get("timeZone", "UTC")}
+            self.send_json(200, ok({"progressId": progress_id}))
+            return
+
+        match = re.fullmatch(r"surveys/([^/]+)/export-responses/([^/]+)/file", path)
+        if method == "GET" and match:
+            with dataset.progressLock:
+                export = dataset.exports.get(match.group(2))
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zip_file:
+                name = "Benchmark " + export['survey']
+                if export['format'] == "json":
+                    zip_file.writestr(name + ".json", dataset.export_json())
+                else:
+                    zip_file.writestr(name + ".csv", dataset.export_csv(export['survey'], export['startDate'],
+                                                                             export['timeZone']))
+            self.send_body(200, archive.getvalue(), "application/zip")
+            return
+
+        match = re.fullmatch(r"surveys/([^/]+)/(export|import)-responses/([^/]+)", path)
+        if method == "GET" and match:
+            result = dataset.check_job(match.group(3))
+            if result is None:
+                self.send_json(404, {"meta": {"httpStatus": "404 - Not Found", "error": {"errorMessage": "no job"}}})
+                return
+            self.send_json(200, ok(result))
+            return
+
+        match = re.fullmatch(r"surveys/([^/]+)/import-responses", path)
+        if method == "POST" and match:
+            self.send_json(200, ok({"progressId": dataset.start_job("PGR_", {})}))
+            return
+
+        self.send_json(404, {"meta": {"httpStatus": "404 - Not Found", "error": {"errorMessage": self.path}}})
+
+# create (but don't start) a mock server on the given port (0 picks a free one)
+def create_server(config, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.dataset = MockDataset(config)
+    return server
+
+# run a mock server until the process is stopped, reporting the port and search window through a queue
+def serve(config, info_queue, port=0):
+    server = create_server(config, port)
+    info_queue.put({"port": server.server_address[1], "windowStart": server.dataset.windowStart})
+    server.serve_forever()
@@ -0,0 +1,193 @@
+# Offline benchmarks for both tools. Starts the mock Qualtrics server (mock_server.py) in its own process, points the
+# shared session layer at it, then drives the Error Handling validator's main() and the copy pipeline and reports
+# tickets/sec, surveys/min and peak memory
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import mock_server
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+VALIDATOR_DIR = os.path.join(REPO_DIR, "Error Handling")
+COPY_DIR = os.path.join(REPO_DIR, "Copy Surveys & Responses")
+sys.path.append(os.path.join(REPO_DIR, "Shared"))
+import sessions
+import metrics
+import ratelimit
+
+# rate used for --rate-limit 0, high enough that the limiter never makes a call wait
+UNLIMITED_RATE = 1e9
+
+# load a tool's main.py under its own module name (both tools have a main.py), with its directory importable
+def load_tool(name, directory):
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(name, os.path.join(directory, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# start the mock server process, returning it with the port/search window it reported
+def start_mock_server(config):
+    info_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=mock_server.serve, args=(config, info_queue), daemon=True)
+    process.start()
+    info = info_queue.get(timeout=60)
+    return process, info
+
+# run func, returning its wall time and (if track_memory) the peak memory traced while it ran
+def measure(func, track_memory):
+    if track_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if track_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return elapsed, peak
+
+# run the validator over every ticket in the mock's window
+def bench_validator(args, info, work_dir):
+    validator = load_tool("error_handling_main", VALIDATOR_DIR)
+    config_dir = os.path.join(work_dir, "ConfigFiles")
+    for directory in ("ConfigFiles", "ReviewFiles", "Checkpoints", "Metrics"):
+        os.makedirs(os.path.join(work_dir, directory), exist_ok=True)
+    validator.CONFIG_FILES_PATH = config_dir
+    validator.REPORT_PATH = os.path.join(work_dir, "ReviewFiles")
+    validator.CHECKPOINT_PATH = os.path.join(work_dir, "Checkpoints")
+    validator.METRICS_PATH = os.path.join(work_dir, "Metrics")
+    validator.CACHE_PATH = os.path.join(work_dir, "cache.sqlite") if args.cache else None
+    validator.EXPORT_POLL_SECONDS = args.poll_seconds
+
+    # one config file pointing at the mock's survey, using the example config's ticket fields
+    with open(os.path.join(VALIDATOR_DIR, "config_example.json")) as json_file:
+        config = json.load(json_file)
+    config['config'].update({
+        "apiToken": "benchmark",
+        "dataCenter": "benchmark",
+        "surveyId": mock_server.VALIDATOR_SURVEY_ID,
+        "lastRunDate": info['windowStart'],
+        "maxWorkers": args.workers,
+        "bulkExport": args.bulk_export,
+        "searchSlices": args.search_slices,
+        "useCache": args.cache
+    })
+    # the example config's brand limit would cap the benchmark at that rate whatever the workers, use --rate-limit
+    config['config'].pop("requestsPerSecond", None)
+    with open(os.path.join(config_dir, "benchmark.json"), "w") as json_file:
+        json.dump(config, json_file, indent=4)
+
+    elapsed, peak = measure(validator.main, not args.no_memory)
+    return {
+        "tickets": args.tickets,
+        "seconds": round(elapsed, 3),
+        "ticketsPerSecond": round(args.tickets / elapsed, 1),
+        "peakMemoryMB": round(peak / 1048576, 2)
+    }
+
+# copy every mock survey through the copy tool's pipeline
+def bench_copy(args, info, work_dir):
+    copy_tool = load_tool("copy_surveys_main", COPY_DIR)
+    import qsf
+    import responses
+    import archive
+    os.environ["source_api_token"] = "benchmark"
+    os.environ["dest_api_token"] = "benchmark"
+    os.environ["source_dc"] = "benchmark-source"
+    os.environ["dest_dc"] = "benchmark-dest"
+    qsf.QSF_CACHE_DIRECTORY = os.path.join(work_dir, "qsf_cache") if args.qsf_cache else None
+    responses.RESPONSE_DIRECTORY = os.path.join(work_dir, "responses")
+    os.makedirs(responses.RESPONSE_DIRECTORY, exist_ok=True)
+    responses.POLL_MIN_SECONDS = args.poll_seconds
+    responses.POLL_MAX_SECONDS = args.poll_seconds * 10
+    responses.IMPORT_CHUNK_ROWS = args.import_chunk_rows
+    copy_tool.USE_ASYNC = args.async_engine
+    copy_tool.VERIFY_COPIES = args.verify
+    copy_tool.DESTINATIONS = [{"name": "dest{n}".format(n=n), "apiToken": "benchmark",
+                               "dataCenter": "benchmark-dest{n}".format(n=n)} for n in range(args.destinations)]
+
+    obj_list = [copy_tool.SurveyObject("{prefix}{n:04d}".format(prefix=mock_server.COPY_SURVEY_PREFIX, n=i))
+                for i in range(args.surveys)]
+    response_archive = archive.ResponseArchive(os.path.join(work_dir, "archive")) if args.archive else None
+    elapsed, peak = measure(lambda: copy_tool.copy_surveys(obj_list, response_archive=response_archive),
+                            not args.no_memory)
+    responses.close_poller()
+    return {
+        "surveys": args.surveys,
+        "responsesPerSurvey": args.responses,
+        "destinations": len(copy_tool.get_destinations()),
+        "seconds": round(elapsed, 3),
+        "surveysPerMinute": round(args.surveys * 60 / elapsed, 1),
+        "peakMemoryMB": round(peak / 1048576, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark both tools against a local mock Qualtrics server")
+    parser.add_argument("--only", choices=["validator", "copy"], help="run just one of the benchmarks")
+    parser.add_argument("--tickets", type=int, default=1000, help="closed tickets in the validator's window")
+    parser.add_argument("--surveys", type=int, default=10, help="surveys for the copy tool to copy")
+    parser.add_argument("--responses", type=int, default=1000, help="responses in each copied survey")
+    parser.add_argument("--payload-bytes", type=int, default=200, help="padding added to every payload")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every request")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="extra random latency per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 429/503")
+    parser.add_argument("--progress-polls", type=int, default=2, help="polls before an export/import completes")
+    parser.add_argument("--poll-seconds", type=float, default=0.05, help="tools' wait between progress polls")
+    parser.add_argument("--import-chunk-rows", type=int, default=0, help="copy tool IMPORT_CHUNK_ROWS")
+    parser.add_argument("--qsf-cache", action="store_true", help="use the copy tool's QSF cache")
+    parser.add_argument("--async-engine", action="store_true", help="run the copy tool on its asyncio engine")
+    parser.add_argument("--destinations", type=int, default=0, help="copy tool DESTINATIONS (0 uses dest_dc)")
+    parser.add_argument("--archive", action="store_true", help="add the copy tool's exports to a local archive")
+    parser.add_argument("--verify", action="store_true", help="verify each copy against a destination export")
+    parser.add_argument("--rate-limit", type=float, default=0.0,
+                        help="requests/sec allowed per brand by the shared rate limiter (0 for no limit)")
+    parser.add_argument("--workers", type=int, default=10, help="validator maxWorkers")
+    parser.add_argument("--search-slices", type=int, default=1, help="validator searchSlices")
+    parser.add_argument("--bulk-export", action="store_true", help="validator bulkExport mode")
+    parser.add_argument("--cache", action="store_true", help="use the validator's payload cache")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc (it slows the run down)")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args()
+
+    config = mock_server.MockConfig(tickets=args.tickets, surveys=args.surveys, responses=args.responses,
+                                    payloadBytes=args.payload_bytes, latency=args.latency,
+                                    latencyJitter=args.latency_jitter, errorRate=args.error_rate,
+                                    progressPolls=args.progress_polls)
+    process, info = start_mock_server(config)
+    rate = args.rate_limit or UNLIMITED_RATE
+    ratelimit.configure(rate=rate, burst=max(1, int(min(rate, args.workers * 10))))
+    sessions.configure(base_url="http://127.0.0.1:{port}".format(port=info['port']), backoff_seconds=0.01)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            if args.only in (None, "validator"):
+                metrics.reset()
+                results['validator'] = bench_validator(args, info, os.path.join(work_dir, "validator"))
+                results['validator']['api'] = metrics.summary()['endpoints']
+            if args.only in (None, "copy"):
+                metrics.reset()
+                results['copy'] = bench_copy(args, info, os.path.join(work_dir, "copy"))
+                results['copy']['api'] = metrics.summary()['endpoints']
+    finally:
+        sessions.close_sessions()
+        process.terminate()
+
+    for name, result in results.items():
+        headline = {key: value for key, value in result.items() if key != "api"}
+        print("{name}: {result}".format(name=name, result=json.dumps(headline)))
+    if args.output:
+        with open(args.output, "w") as json_file:
+            json.dump(results, json_file, indent=4)
+    return results
+
+if __name__ == "__main__":
+    main()
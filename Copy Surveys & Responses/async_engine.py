@@ -0,0 +1,440 @@
+# asyncio engine for the copy stages. Every survey runs as a coroutine instead of holding threads, so a brand
+# migration of thousands of surveys runs in one process: all HTTP goes through one aiohttp session, each stage and
+# each brand is bounded by a semaphore, and an error no other survey could get past (a bad token, no permission)
+# cancels the whole run instead of failing every survey one at a time. Selected with USE_ASYNC in main.py, and
+# needs aiohttp installed
+import asyncio
+import json
+import os
+import time
+import zipfile
+import aiohttp
+import sessions
+import ratelimit
+import metrics
+import poller
+import qsf
+import responses
+import verify
+
+# calls allowed in flight at once per brand (data center + API token)
+BRAND_CONCURRENCY = 50
+# statuses that mean every other call with the same token will fail too, so the run is cancelled
+FATAL_STATUSES = (401, 403)
+# factor the wait between progress checks grows by, from responses.POLL_MIN_SECONDS up to POLL_MAX_SECONDS
+POLL_BACKOFF = 1.5
+
+class FatalError(Exception):
+    """ Exception raised when a call fails in a way that would fail every survey, cancelling the run
+
+    Attributes:
+        status -- HTTP status of the failed call
+        url -- the call's URL
+    """
+    def __init__(self, status, url):
+        self.status = status
+        self.url = url
+
+    def __str__(self):
+        return '{status} from {url}, cancelling the run'.format(status=self.status, url=self.url)
+
+class CallFailed(Exception):
+    """ Exception raised when a call still fails after its retries, failing just the survey it was for
+
+    Attributes:
+        status -- HTTP status of the failed call
+        url -- the call's URL
+        body -- the response body, for the error message
+    """
+    def __init__(self, status, url, body):
+        self.status = status
+        self.url = url
+        self.body = body
+
+    def __str__(self):
+        return '{status} from {url}: {body}'.format(status=self.status, url=self.url, body=self.body[:200])
+
+class AsyncClient:
+    """ one aiohttp session for the whole run, with the same rate limiting, retries and metrics as
+    sessions.RetrySession
+
+    Attributes:
+        session -- the aiohttp.ClientSession (must be created inside the running event loop)
+        brandLimit -- calls allowed in flight at once per brand
+        brands -- (data center, API token) -> semaphore bounding that brand's calls in flight
+    """
+    def __init__(self, brandLimit=BRAND_CONCURRENCY):
+        self.session = aiohttp.ClientSession(headers={"Accept-Encoding": "gzip, deflate"},
+                                             connector=aiohttp.TCPConnector(limit=0))
+        self.brandLimit = brandLimit
+        self.brands = {}
+
+    def brand(self, dc, token):
+        if (dc, token) not in self.brands:
+            self.brands[(dc, token)] = asyncio.Semaphore(self.brandLimit)
+        return self.brands[(dc, token)]
+
+    # make a call, retrying throttled/transient failures, and return the response body. body is a function building
+    # the request body, called again for each attempt (form data and open files can't be sent twice). With
+    # download_path the body is streamed to that file instead, and nothing is returned
+    async def request(self, method, dc, url, headers, body=None, params=None, download_path=None):
+        url = sessions.resolve_url(url)
+        retry_statuses = sessions.RETRY_POST_STATUSES if method == "POST" else sessions.RETRY_STATUSES
+        token = headers.get("X-API-TOKEN")
+        limiter = ratelimit.get_limiter(dc, token)
+        attempt = 0
+        start = time.monotonic()
+        async with self.brand(dc, token):
+            while True:
+                await limiter.acquire_async()
+                data = body() if body is not None else None
+                delay = None
+                try:
+                    async with self.session.request(method, url, headers=headers, data=data,
+                                                    params=params) as response:
+                        if response.status == 429:
+                            limiter.throttled(sessions.retry_after_seconds(response))
+                        else:
+                            limiter.succeeded()
+                        if response.status not in retry_statuses or attempt >= sessions.MAX_RETRIES:
+                            content, received = await self.read(response, download_path)
+                            metrics.record_call(method, url, response.status, time.monotonic() - start,
+                                                len(data) if isinstance(data, (bytes, str)) else 0, received,
+                                                attempt)
+                            self.check(response.status, url, content)
+                            return content
+                        delay = sessions.retry_after_seconds(response)
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as err:
+                    # like RetrySession, a POST is only resent if the connection couldn't be made at all
+                    if attempt >= sessions.MAX_RETRIES or (method == "POST" and
+                                                           not isinstance(err, aiohttp.ClientConnectorError)):
+                        metrics.record_call(method, url, 0, time.monotonic() - start, retries=attempt)
+                        raise
+                finally:
+                    if hasattr(data, "close"):
+                        data.close()
+                if delay is None:
+                    delay = sessions.backoff_delay(attempt)
+                print("Retrying {method} {url} in {delay:.1f}s (attempt {n})".format(
+                    method=method, url=url, delay=delay, n=attempt + 1))
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    # read a response body, or stream it to download_path a chunk at a time. Returns the body and its size
+    async def read(self, response, download_path):
+        if download_path is None or response.status >= 400:
+            content = await response.read()
+            return content, len(content)
+        received = 0
+        with open(download_path, 'wb') as output_file:
+            async for chunk in response.content.iter_chunked(responses.DOWNLOAD_CHUNK_BYTES):
+                output_file.write(chunk)
+                received += len(chunk)
+        return None, received
+
+    def check(self, status, url, content):
+        if status < 400:
+            return
+        if status in FATAL_STATUSES:
+            raise FatalError(status, url)
+        print("Http error:", status, url)
+        raise CallFailed(status, url, content.decode("utf-8", "replace"))
+
+    # make a call and return the "result" of its JSON response
+    async def result(self, method, dc, url, headers, body=None, params=None):
+        content = await self.request(method, dc, url, headers, body, params)
+        return json.loads(content)['result']
+
+    async def close(self):
+        await self.session.close()
+
+class AsyncCopyEngine:
+    """ runs the copy stages for a list of SurveyObjects on one event loop
+
+    Each survey's QSF download and response export/download run side by side. Each destination then gets the
+    survey as soon as the QSF is downloaded and its responses once the export is, and is recorded in the manifest
+    (if there is one), as in main.copy_pipeline.
+
+    Attributes:
+        destinations -- the destination brands, as in main.DESTINATIONS
+        stageWorkers -- stage name -> surveys allowed in that stage at once (main.STAGE_WORKERS)
+        copyManifest -- manifest.Manifest to record finished surveys in, or None
+        responseArchive -- archive.ResponseArchive each export is added to, or None
+        verifyCopies -- if True, each destination is exported and verified (verify.py) after its import
+        brandLimit -- calls allowed in flight at once per brand
+        failures -- (survey object, destination name, exception) for every copy that didn't finish
+    """
+    def __init__(self, destinations, stageWorkers, copyManifest=None, responseArchive=None, verifyCopies=False,
+                 brandLimit=BRAND_CONCURRENCY):
+        self.destinations = destinations
+        self.stageWorkers = stageWorkers
+        self.copyManifest = copyManifest
+        self.responseArchive = responseArchive
+        self.verifyCopies = verifyCopies
+        self.brandLimit = brandLimit
+        self.failures = []
+
+    # copy every survey, returning once all have finished or failed. A FatalError cancels every survey still running
+    async def run(self, obj_list):
+        self.failures = []
+        self.limits = {name: asyncio.Semaphore(workers) for name, workers in self.stageWorkers.items()}
+        self.client = AsyncClient(self.brandLimit)
+        tasks = [asyncio.create_task(self.copy_survey(obj)) for obj in obj_list]
+        try:
+            await asyncio.gather(*tasks)
+        except FatalError:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            await self.client.close()
+        return obj_list
+
+    async def copy_survey(self, obj):
+        # the definition and the responses don't depend on each other, so they're fetched side by side, once for
+        # every destination
+        download = asyncio.ensure_future(self.stage("download_qsf", self.download_qsf, obj))
+        export = asyncio.ensure_future(self.copy_export(obj))
+        try:
+            results = await asyncio.gather(*[self.copy_to(obj, destination, download, export)
+                                             for destination in self.destinations], return_exceptions=True)
+        finally:
+            download.cancel()
+            export.cancel()
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if all(result for result in results):
+            obj.qsfData = b""
+            responses.remove_export(obj)
+        return
+
+    # copy one survey into one destination, returning whether it finished. A failure only stops this destination
+    async def copy_to(self, obj, destination, download, export):
+        name = destination['name']
+        try:
+            await asyncio.shield(download)
+            await self.stage("import_qsf", lambda obj: self.import_qsf(obj, destination), obj)
+            await asyncio.shield(export)
+            await self.stage("request_import", lambda obj: self.import_responses(obj, destination), obj)
+            if self.verifyCopies:
+                await self.stage("verify_import", lambda obj: self.verify_import(obj, destination), obj)
+            if self.copyManifest is not None:
+                self.copyManifest.record(obj, name)
+            return True
+        except (FatalError, asyncio.CancelledError):
+            raise
+        except Exception as err:
+            self.failures.append((obj, name, err))
+            print("{survey} failed for {name}: {err}".format(survey=obj.sourceId, name=name, err=repr(err)))
+            return False
+
+    # run one stage for a survey within the stage's worker limit, timing it for the metrics
+    async def stage(self, name, func, obj):
+        async with self.limits[name]:
+            started = time.monotonic()
+            try:
+                return await func(obj)
+            finally:
+                metrics.record_stage("async:" + name, time.monotonic() - started)
+
+    async def copy_export(self, obj):
+        await self.stage("request_export", self.request_export, obj)
+        await self.stage("download_export", self.download_export, obj)
+        if self.responseArchive is not None:
+            await self.stage("archive_export", self.archive_export, obj)
+
+    # export the destination and compare it with the source export (on the threaded helpers, off the event loop)
+    async def verify_import(self, obj, destination):
+        await asyncio.to_thread(verify.verify_copy, obj, destination)
+
+    # add the downloaded export to the local archive (pyarrow work, so it runs off the event loop)
+    async def archive_export(self, obj):
+        await asyncio.to_thread(responses.archive_export, obj, self.responseArchive)
+
+    # poll a job's progress until it's complete, backing off between checks
+    async def wait_for(self, name, kind, check):
+        started = time.monotonic()
+        interval = responses.POLL_MIN_SECONDS
+        while True:
+            result = await check()
+            status = result.get('status')
+            if status in ("complete", "failed"):
+                metrics.record_poll(kind, time.monotonic() - started)
+                if status == "failed":
+                    raise poller.JobFailed(name, result)
+                return result
+            print("Polling - {name} {pct}%, next check in {wait:.1f}s".format(
+                name=name, pct=result.get('percentComplete'), wait=interval))
+            await asyncio.sleep(interval)
+            interval = min(responses.POLL_MAX_SECONDS, interval * POLL_BACKOFF)
+
+    # the async versions of qsf.download_qsf/import_qsf, sharing its QSF cache
+    async def download_qsf(self, obj):
+        if not obj.qsfNeeded:
+            return
+        dc = os.environ.get("source_dc")
+        headers = responses.get_headers("source")
+        cache_key = None
+        if qsf.QSF_CACHE_DIRECTORY:
+            survey = await self.client.result("GET", dc, "https://{dc}.qualtrics.com/API/v3/surveys/{id}".format(
+                dc=dc, id=obj.sourceId), headers)
+            cache_key = "{id}|{modified}".format(id=obj.sourceId, modified=survey['lastModifiedDate'])
+            cached = qsf.load_cached_qsf(cache_key)
+            if cached is not None:
+                obj.qsfData, obj.surveyName = cached
+                return
+        content = await self.client.request("GET", dc, "https://{dc}.qualtrics.com/API/v3/survey-definitions/{id}".format(
+            dc=dc, id=obj.sourceId), headers, params={'format': 'qsf'})
+        qsf_result, qsf_text = qsf.result_slice(content.decode("utf-8"))
+        obj.surveyName = qsf_result['SurveyEntry']['SurveyName']
+        obj.qsfData = qsf_text.encode("utf-8")
+        if cache_key is not None:
+            qsf.store_qsf(cache_key, obj.qsfData, obj.surveyName)
+        return
+
+    async def import_qsf(self, obj, destination):
+        if destination['name'] in obj.destIds:
+            return
+        dc = destination['dataCenter']
+
+        def form():
+            data = aiohttp.FormData()
+            data.add_field("name", obj.surveyName + " - new")
+            data.add_field("file", obj.qsfData, filename=obj.sourceId + "_qsf.qsf", content_type=qsf.QSF_MIME_TYPE)
+            return data
+
+        result = await self.client.result("POST", dc, "https://{dc}.qualtrics.com/API/v3/surveys".format(dc=dc),
+                                          {"X-API-TOKEN": destination['apiToken']}, form)
+        obj.destIds[destination['name']] = result['id']
+        return
+
+    # the async versions of responses.request_export/download_export
+    async def request_export(self, obj):
+        dc = os.environ.get("source_dc")
+        headers = responses.get_headers("source")
+        url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses".format(dc=dc, id=obj.sourceId)
+        body = responses.export_body(obj.lastResponseDate)
+        progress_id = (await self.client.result("POST", dc, url, headers, lambda: body))['progressId']
+
+        async def check():
+            return await self.client.result("GET", dc, url + "/" + progress_id, headers)
+
+        result = await self.wait_for("export " + obj.sourceId, "export_responses", check)
+        obj.exportFileId = result['fileId']
+        return
+
+    async def download_export(self, obj):
+        dc = os.environ.get("source_dc")
+        url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses/{fileId}/file".format(
+            dc=dc, id=obj.sourceId, fileId=obj.exportFileId)
+        zip_path = responses.export_zip_path(obj)
+        await self.client.request("GET", dc, url, responses.get_headers("source"), download_path=zip_path)
+        # unzipping and scanning for the newest response is file work, done off the event loop
+        await asyncio.to_thread(responses.unpack_export, obj, zip_path)
+        return
+
+    # the async version of responses.request_import, including its chunked mode
+    async def import_responses(self, obj, destination):
+        survey_id = obj.destIds[destination['name']]
+        source = await asyncio.to_thread(responses.import_source, obj, destination)
+        if source is None:
+            print("No new responses to import for {id}".format(id=survey_id))
+            return
+        path, member = source
+        try:
+            if responses.IMPORT_CHUNK_ROWS:
+                chunk_dir = os.path.join(responses.RESPONSE_DIRECTORY, obj.sourceId, "chunks", destination['name'])
+                chunks = await asyncio.to_thread(responses.split_responses, path, member, chunk_dir,
+                                                 responses.IMPORT_CHUNK_ROWS)
+                if len(chunks) > 1:
+                    await self.import_chunks(survey_id, chunks, destination)
+                    return
+                os.remove(chunks[0][0])
+            await self.import_file(survey_id, lambda: open_upload(path, member), "import " + survey_id, destination)
+        finally:
+            if path != obj.responsePath:
+                os.remove(path)
+        print("Finished the import for {id}".format(id=survey_id))
+        return
+
+    async def import_file(self, survey_id, body, name, destination):
+        progress_id = await self.post_import(survey_id, body, destination)
+        return await self.wait_for_import(survey_id, progress_id, name, destination)
+
+    # start an import, returning its progress ID
+    async def post_import(self, survey_id, body, destination):
+        dc = destination['dataCenter']
+        headers = responses.dest_headers(destination, "text/csv; charset=UTF-8")
+        url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/import-responses".format(dc=dc, id=survey_id)
+        return (await self.client.result("POST", dc, url, headers, body))['progressId']
+
+    async def wait_for_import(self, survey_id, progress_id, name, destination):
+        dc = destination['dataCenter']
+        url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/import-responses/{progress}".format(
+            dc=dc, id=survey_id, progress=progress_id)
+
+        async def check():
+            return await self.client.result("GET", dc, url, responses.dest_headers(destination))
+
+        return await self.wait_for(name, "import_responses", check)
+
+    # import the chunks like responses.import_chunks: a chunk is only posted again if the server turned its post away
+    # without starting an import (a 429/503, or no connection could be made)
+    async def import_chunks(self, survey_id, chunks, destination):
+        limit = asyncio.Semaphore(responses.IMPORT_CHUNK_WORKERS)
+        total_rows = sum(rows for _, rows in chunks)
+
+        async def import_chunk(number, path):
+            name = "import {id} chunk {n}/{total}".format(id=survey_id, n=number + 1, total=len(chunks))
+            progress_id = None
+            async with limit:
+                for attempt in range(responses.IMPORT_CHUNK_RETRIES + 1):
+                    try:
+                        if progress_id is None:
+                            progress_id = await self.post_import(survey_id, lambda: open(path, 'rb'), destination)
+                        await self.wait_for_import(survey_id, progress_id, name, destination)
+                        os.remove(path)
+                        return
+                    except (CallFailed, aiohttp.ClientError) as err:
+                        if attempt == responses.IMPORT_CHUNK_RETRIES or (progress_id is None and
+                                                                         not post_can_resend(err)):
+                            raise
+                        print("{name} failed ({err}), retrying".format(name=name, err=repr(err)))
+
+        results = await asyncio.gather(*[import_chunk(n, path) for n, (path, _) in enumerate(chunks)],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, (FatalError, asyncio.CancelledError)):
+                raise result
+        imported_rows = sum(rows for (_, rows), result in zip(chunks, results) if result is None)
+        failed = [path for (path, _), result in zip(chunks, results) if result is not None]
+        if failed:
+            raise CallFailed(0, survey_id, "chunked import sent {done} of {total} responses, failed chunks: "
+                                           "{failed}".format(done=imported_rows, total=total_rows, failed=failed))
+        print("Finished the import for {id}, {total} responses in {n} chunks".format(id=survey_id, total=total_rows,
+                                                                                     n=len(chunks)))
+        return
+
+# whether a POST that still failed after its retries can be sent again, like sessions.post_can_resend: it was turned
+# away with a 429/503, or no connection could be made
+def post_can_resend(err):
+    if isinstance(err, CallFailed):
+        return err.status in sessions.RETRY_POST_STATUSES
+    return isinstance(err, aiohttp.ClientConnectorError)
+
+# a CSV as an upload body: an unzipped file, or its entry in the export zip when piping
+def open_upload(path, member=""):
+    if not member:
+        return open(path, 'rb')
+    # the member keeps the zip's file open until the member itself is closed
+    with zipfile.ZipFile(path) as zip_file:
+        return zip_file.open(member)
+
+# copy every survey on a new event loop, returning the failures
+def run(obj_list, destinations, stageWorkers, copyManifest=None, responseArchive=None, verifyCopies=False,
+        brandLimit=BRAND_CONCURRENCY):
+    engine = AsyncCopyEngine(destinations, stageWorkers, copyManifest, responseArchive, verifyCopies, brandLimit)
+    asyncio.run(engine.run(obj_list))
+    return engine.failures
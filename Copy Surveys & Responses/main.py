@@ -1,38 +1,97 @@
 # Program to take an Excel file of Survey ID's that exist in one Qualtrics brand,
-# and then to copy those surveys and their response data to a separate Qualtrics brand
+# and then to copy those surveys and their response data to one or more separate Qualtrics brands
 import os
+import sys
+# shared helpers (pooled HTTP sessions) live in the Shared directory next to both tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Shared"))
 import responses
 import qsf
+import sessions
+import metrics
+import pipeline
+import manifest
+import archive
+import verify
+import functools
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import time
 import threading
 
+# destination brands every survey is copied into, each {"name": ..., "apiToken": ..., "dataCenter": ...}. Surveys
+# are downloaded/exported from the source brand once and imported into all of them at the same time. Left empty,
+# the one destination from the dest_api_token/dest_dc environment variables (named "dest") is used
+DESTINATIONS = []
+# manifest of the surveys already copied, so reruns only copy new responses (None copies everything every run)
+MANIFEST_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "copy_manifest.json")
+# local archive the exported responses are added to (Shared/archive.py, needs pyarrow), None to skip archiving
+ARCHIVE_PATH = None
+# after each import, export the destination survey and check it holds every response imported (verify.py)
+VERIFY_COPIES = False
+# run each survey through its stages independently (True), or run each stage for every survey before the next (False)
+USE_PIPELINE = True
+# run the stages on the asyncio engine (async_engine.py, needs aiohttp) instead of threads, for very large batches
+USE_ASYNC = False
+# surveys allowed in each stage at once when using the pipeline or the asyncio engine
+STAGE_WORKERS = {
+    "download_qsf": 10,
+    "import_qsf": 10,
+    "request_export": 10,
+    "download_export": 10,
+    "archive_export": 2,
+    "request_import": 10,
+    "request_verify": 10,
+    "verify_import": 4
+}
+
 # Defining the survey object to hold the relevant QSF/response data
 class SurveyObject:
     """ class object created per survey
 
     Attributes:
         sourceId -- the survey ID from the originating brand
-        qsfPath -- file path to the QSF that is downloaded for each survey
-        responsePath -- file path to the downloaded CSV containing responses for each survey
-        destId -- the survey ID of the newly created survey in the destination brand
+        qsfData -- the survey's QSF as downloaded, held in memory until it's imported
+        exportFileId -- file ID of the finished response export, to download it
+        responsePath -- file path to the downloaded CSV containing responses for each survey (or to the export zip
+                        when it's piped straight into the import)
+        responseMember -- name of the CSV inside the zip at responsePath when piping, otherwise empty
+        destIds -- destination name -> the survey ID of the newly created survey in that destination brand
         surveyName -- name of the survey that is being copied from the original brand
+        qsfNeeded -- False when every destination already has the survey (from the manifest), so the QSF isn't
+                     downloaded
+        lastResponseDates -- destination name -> newest RecordedDate copied there by an earlier run (from the manifest)
+        lastResponseIds -- destination name -> ResponseIds copied there from its lastResponseDates second
+        lastResponseDate -- the export only includes responses recorded after this (the oldest of lastResponseDates)
+        newestResponseDate -- newest RecordedDate in this run's export, saved to the manifest once imported
+        newestResponseIds -- ResponseIds in this run's export recorded in the newestResponseDate second
+        verifyFileIds -- destination name -> file ID of the destination export being verified
+        verifications -- destination name -> the destination's response totals from its last verification (from the
+                         manifest, then this run's), the baseline the next verification is compared against
 
      """
     def __init__(self, survey):
         self.sourceId = survey
-        self.qsfPath = ""
+        self.qsfData = b""
+        self.exportFileId = ""
         self.responsePath = ""
-        self.destId = ""
+        self.responseMember = ""
+        self.destIds = {}
         self.surveyName = ""
+        self.qsfNeeded = True
+        self.lastResponseDates = {}
+        self.lastResponseIds = {}
+        self.lastResponseDate = None
+        self.newestResponseDate = None
+        self.newestResponseIds = []
+        self.verifyFileIds = {}
+        self.verifications = {}
 
 # defining a multi-threading function to speed up API call processing, want it to be re-usable
 # making it dynamic since will be hitting multiple endpoints for multiple functions that need threading
 def runner(func_name, obj_list):
     threads = []
     check_function = str(func_name)
-    with ThreadPoolExecutor(max_workers=20) as executor:
+    with metrics.stage("runner:" + func_name.__name__), ThreadPoolExecutor(max_workers=20) as executor:
         for obj in obj_list:
             threads.append(executor.submit(func_name, obj))
         executor.shutdown(wait=True)
@@ -48,6 +107,110 @@ def runner(func_name, obj_list):
             print("All response imports have been started.\n")
     return obj_list
 
+# the copy stages as a graph: the QSF download and the response export don't depend on each other, so they overlap.
+# The response import needs both the new survey (import_qsf) and the exported file (download_export). Exports and
+# imports are waited on by the shared progress poller, so no stage worker sits idle while they run. The QSF and
+# response imports get a stage per destination, so a slow or failing destination doesn't hold up the others. With a
+# manifest, each destination is recorded in it once its responses are imported (and verified, if VERIFY_COPIES).
+# With an archive, each export is archived alongside the imports
+def copy_pipeline(destinations, copy_manifest=None, response_archive=None, verify_copies=False):
+    stages = [
+        pipeline.Stage("download_qsf", qsf.download_qsf, STAGE_WORKERS["download_qsf"]),
+        pipeline.Stage("request_export", responses.request_export, STAGE_WORKERS["request_export"]),
+        pipeline.Stage("download_export", responses.download_export, STAGE_WORKERS["download_export"],
+                       after=["request_export"])
+    ]
+    # the last stage each destination goes through, the export is kept until all of them are done with it
+    last_stage = "verify_import:" if verify_copies else "request_import:"
+    finish_after = [last_stage + destination['name'] for destination in destinations]
+    if response_archive is not None:
+        stages.append(pipeline.Stage("archive_export",
+                                     functools.partial(responses.archive_export, response_archive=response_archive),
+                                     STAGE_WORKERS["archive_export"], after=["download_export"]))
+        finish_after.append("archive_export")
+    for destination in destinations:
+        name = destination['name']
+        stages.append(pipeline.Stage("import_qsf:" + name, functools.partial(qsf.import_qsf, destination=destination),
+                                     STAGE_WORKERS["import_qsf"], after=["download_qsf"]))
+        stages.append(pipeline.Stage("request_import:" + name,
+                                     functools.partial(responses.request_import, destination=destination),
+                                     STAGE_WORKERS["request_import"], after=["import_qsf:" + name, "download_export"]))
+        if verify_copies:
+            stages.append(pipeline.Stage("request_verify:" + name,
+                                         functools.partial(verify.request_verify, destination=destination),
+                                         STAGE_WORKERS["request_verify"], after=["request_import:" + name]))
+            stages.append(pipeline.Stage("verify_import:" + name,
+                                         functools.partial(verify.verify_import, destination=destination),
+                                         STAGE_WORKERS["verify_import"], after=["request_verify:" + name]))
+        if copy_manifest is not None:
+            stages.append(pipeline.Stage("record_copy:" + name,
+                                         functools.partial(copy_manifest.record, destination_name=name), 1,
+                                         after=[last_stage + name]))
+    stages.append(pipeline.Stage("finish_copy", finish_copy, 1, after=finish_after))
+    return pipeline.Pipeline(stages)
+
+# once every destination has the survey and its responses, drop the QSF and any piped export zip
+def finish_copy(obj):
+    obj.qsfData = b""
+    responses.remove_export(obj)
+    return
+
+# the destinations to copy into: DESTINATIONS, or the single destination from the environment variables
+def get_destinations():
+    if DESTINATIONS:
+        return DESTINATIONS
+    return [{"name": "dest", "apiToken": os.environ.get("dest_api_token"), "dataCenter": os.environ.get("dest_dc")}]
+
+# Perform the following actions using other modules and the ThreadPoolExecutor
+# 1. download the QSF from the original brand
+# 2. import the QSF into each destination brand
+# 3. export the responses from the survey in the original brand
+# 4. import the responses into the new survey in each destination brand
+# 5. optionally (VERIFY_COPIES) export each destination survey and check every response made it
+# Surveys already in the manifest skip steps 1 and 2, and only export/import responses newer than the last copy
+def copy_surveys(obj_list, copy_manifest=None, destinations=None, response_archive=None):
+    if destinations is None:
+        destinations = get_destinations()
+    if copy_manifest is not None:
+        copy_manifest.apply(obj_list, [destination['name'] for destination in destinations])
+    if USE_ASYNC:
+        # only imported when selected, so the threaded modes don't need aiohttp installed
+        import async_engine
+        failures = async_engine.run(obj_list, destinations, STAGE_WORKERS, copy_manifest, response_archive,
+                                    VERIFY_COPIES)
+        print("All surveys have been copied, {n} failed.\n".format(n=len(failures)))
+        return obj_list
+    if USE_PIPELINE:
+        copy_pipeline(destinations, copy_manifest, response_archive, VERIFY_COPIES).run(obj_list)
+        print("All surveys have been copied.\n")
+        return obj_list
+
+    # the stage-by-stage runner goes through the destinations one after another for each survey
+    def import_qsf_everywhere(obj):
+        for destination in destinations:
+            qsf.import_qsf(obj, destination)
+
+    # the runner doesn't report which surveys failed, so the manifest is updated as each import finishes
+    def start_import_and_record(obj):
+        for destination in destinations:
+            responses.start_import(obj, destination)
+            if VERIFY_COPIES:
+                verify.verify_copy(obj, destination)
+            if copy_manifest is not None:
+                copy_manifest.record(obj, destination['name'])
+        finish_copy(obj)
+
+    def archive_responses(obj):
+        responses.archive_export(obj, response_archive)
+
+    runner(qsf.download_qsf, obj_list)
+    runner(import_qsf_everywhere, obj_list)
+    runner(responses.get_export_file, obj_list)
+    if response_archive is not None:
+        runner(archive_responses, obj_list)
+    runner(start_import_and_record, obj_list)
+    return obj_list
+
 def main():
     # defining environment variables for the source and destination brands
     os.environ["source_api_token"] = ""
@@ -55,8 +218,10 @@ def main():
     os.environ["source_dc"] = ""
     os.environ["dest_dc"] = ""
 
-    # specify path for file that contains survey IDs
+    # specify path for file that contains survey IDs, and the directory for the run's metrics files
     file_path = ''
+    metrics_path = ''
+    run_start = time.monotonic()
 
     # process the file and try creating a data frame object for the survey column
     try:
@@ -68,15 +233,16 @@ def main():
     id_list = processed_file['SurveyID'].values.tolist()
     obj_list = [SurveyObject(survey_id) for survey_id in id_list]
 
-    # Perform the following actions using other modules and the ThreadPoolExecutor
-    # 1. download the QSF from the original brand
-    # 2. import the QSF into the destination brand
-    # 3. export the responses from the survey in the original brand
-    # 4. import the responses into the new survey in the destination brand
-    runner(qsf.download_qsf, obj_list)
-    runner(qsf.import_qsf, obj_list)
-    runner(responses.get_export_file, obj_list)
-    runner(responses.start_import, obj_list)
+    # copy each survey and its responses to the destination brands
+    copy_manifest = manifest.Manifest(MANIFEST_PATH) if MANIFEST_PATH else None
+    response_archive = archive.ResponseArchive(ARCHIVE_PATH) if ARCHIVE_PATH else None
+    copy_surveys(obj_list, copy_manifest, response_archive=response_archive)
+    responses.close_poller()
+    sessions.close_sessions()
+
+    # per-endpoint/per-stage timings for the run, written to the metrics directory
+    metrics.record_stage("main", time.monotonic() - run_start)
+    metrics.write_summary(metrics_path, "copy_surveys")
     return
 
 if __name__ == "__main__":
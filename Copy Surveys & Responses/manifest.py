@@ -0,0 +1,90 @@
+# Persistent record of the surveys the copy tool has already copied, so a rerun only moves what changed: a survey
+# in the manifest reuses its destination surveys (no QSF download/import) and exports only the responses recorded
+# after the last copy, which are appended to the destination surveys
+import json
+import os
+import threading
+
+class Manifest:
+    """ JSON file mapping each copied source survey to its survey in each destination brand and copy watermark
+
+    Each entry is keyed by sourceId and holds surveyName and, per destination name, destId, lastResponseDate (the
+    newest RecordedDate copied to that destination so far, as an ISO 8601 UTC string, or None if no responses have
+    been copied yet), lastResponseIds (the ResponseIds copied from that second, the dates being whole seconds) and
+    verification (the destination's response totals from its last verification, see verify.py,
+    or None if it hasn't been verified).
+
+    Attributes:
+        path -- file path of the manifest JSON
+        entries -- sourceId -> entry, as loaded from the file plus this run's updates
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as json_file:
+                self.entries = json.load(json_file)
+        except FileNotFoundError:
+            self.entries = {}
+        # manifests written before destinations were added had one destination, the default "dest"
+        for entry in self.entries.values():
+            if "destId" in entry:
+                entry['destinations'] = {"dest": {"destId": entry.pop('destId'),
+                                                  "lastResponseDate": entry.pop('lastResponseDate')}}
+
+    # copy what the manifest knows about each survey onto its object, so the stages can skip what's already done.
+    # The export starts from the oldest watermark of the destinations, or from the beginning if any destination
+    # hasn't had responses copied yet
+    def apply(self, obj_list, destination_names):
+        for obj in obj_list:
+            entry = self.entries.get(obj.sourceId)
+            if entry is None:
+                continue
+            obj.surveyName = entry['surveyName']
+            for name in destination_names:
+                copied = entry['destinations'].get(name)
+                if copied is not None:
+                    obj.destIds[name] = copied['destId']
+                    obj.lastResponseDates[name] = copied['lastResponseDate']
+                    if copied.get('lastResponseIds') is not None:
+                        obj.lastResponseIds[name] = set(copied['lastResponseIds'])
+                    if copied.get('verification') is not None:
+                        obj.verifications[name] = copied['verification']
+            obj.qsfNeeded = len(obj.destIds) < len(destination_names)
+            watermarks = [obj.lastResponseDates.get(name) for name in destination_names]
+            obj.lastResponseDate = None if None in watermarks else min(watermarks)
+        return obj_list
+
+    # save a survey whose responses have been imported into one destination, moving that destination's watermark
+    # up to the newest response copied
+    def record(self, obj, destination_name):
+        with self.lock:
+            entry = self.entries.setdefault(obj.sourceId, {"surveyName": obj.surveyName, "destinations": {}})
+            entry['surveyName'] = obj.surveyName
+            previous = entry['destinations'].get(destination_name, {})
+            previous_date = previous.get('lastResponseDate')
+            previous_ids = previous.get('lastResponseIds') or []
+            # the IDs in the watermark's second: the new export's if it moved the watermark on, both if it's the
+            # same second
+            if obj.newestResponseDate is None or (previous_date is not None and obj.newestResponseDate < previous_date):
+                last_date, last_ids = previous_date, previous_ids
+            elif obj.newestResponseDate == previous_date:
+                last_date, last_ids = previous_date, sorted(set(previous_ids) | set(obj.newestResponseIds))
+            else:
+                last_date, last_ids = obj.newestResponseDate, sorted(obj.newestResponseIds)
+            entry['destinations'][destination_name] = {
+                "destId": obj.destIds[destination_name],
+                "lastResponseDate": last_date,
+                "lastResponseIds": last_ids,
+                "verification": obj.verifications.get(destination_name, previous.get('verification'))
+            }
+            self.save()
+        return
+
+    # write to a temp file then swap it in, so an interrupted run never leaves a half written manifest
+    def save(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as json_file:
+            json.dump(self.entries, json_file, indent=4)
+        os.replace(temp_path, self.path)
+        return
@@ -0,0 +1,110 @@
+# Per-survey pipeline scheduler for the copy tool. Instead of running each stage for every survey before starting the
+# next stage, each SurveyObject moves through the stage graph on its own: a stage starts for a survey as soon as the
+# stages it depends on have finished for that survey, and each stage has its own worker limit
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+
+class Stage:
+    """ one step of the pipeline, run once per survey object
+
+    Attributes:
+        name -- stage name used in progress output and metrics
+        func -- function called with the survey object. If it returns a Future (e.g. a job handed to the progress
+                poller), the stage finishes when that Future does, without holding one of the stage's workers
+        workers -- how many surveys may be in this stage at once
+        after -- names of the stages that must finish for a survey before this one starts
+    """
+    def __init__(self, name, func, workers, after=()):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.after = tuple(after)
+
+class Pipeline:
+    """ runs a graph of Stages over a list of survey objects
+
+    Attributes:
+        stages -- the Stages, by name
+        dependents -- stage name -> names of the stages waiting on it
+        failures -- (survey object, stage name, exception) for every survey that stopped part way through
+    """
+    def __init__(self, stages):
+        self.stages = {stage.name: stage for stage in stages}
+        self.dependents = {stage.name: [] for stage in stages}
+        for stage in stages:
+            for name in stage.after:
+                self.dependents[name].append(stage.name)
+        self.failures = []
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+
+    # run every stage for every object, returning once each object has finished (or failed) all its stages
+    def run(self, obj_list):
+        self.failures = []
+        executors = {name: ThreadPoolExecutor(max_workers=stage.workers, thread_name_prefix=name)
+                     for name, stage in self.stages.items()}
+        # per object: stage name -> number of dependencies still to finish, and stages not yet finished/skipped
+        waiting = [{name: len(stage.after) for name, stage in self.stages.items()} for obj in obj_list]
+        self.outstanding = len(obj_list) * len(self.stages)
+
+        # a stage finished (or failed) for one object: start whatever it unblocked
+        def stage_done(index, name, started, future):
+            obj = obj_list[index]
+            error = future.exception()
+            # a deferred stage returned its own Future, the stage is only done when that is
+            if error is None and isinstance(future.result(), Future):
+                future.result().add_done_callback(lambda done: stage_done(index, name, started, done))
+                return
+            metrics.record_stage("pipeline:" + name, time.monotonic() - started)
+            ready = []
+            with self.lock:
+                if error is not None:
+                    self.failures.append((obj, name, error))
+                    # nothing downstream of a failed stage can run for this survey
+                    skipped = self.skip_dependents(waiting[index], name)
+                    self.outstanding -= 1 + skipped
+                else:
+                    self.outstanding -= 1
+                    for dependent in self.dependents[name]:
+                        # already skipped because another of its dependencies failed
+                        if waiting[index][dependent] is None:
+                            continue
+                        waiting[index][dependent] -= 1
+                        if waiting[index][dependent] == 0:
+                            ready.append(dependent)
+                if self.outstanding == 0:
+                    self.finished.notify_all()
+            if error is not None:
+                print("{survey} failed at {stage}: {err}".format(survey=obj.sourceId, stage=name, err=repr(error)))
+            for dependent in ready:
+                submit(index, dependent)
+
+        def submit(index, name):
+            started = time.monotonic()
+            future = executors[name].submit(self.stages[name].func, obj_list[index])
+            future.add_done_callback(lambda done: stage_done(index, name, started, done))
+
+        try:
+            # start every stage that has no dependencies, for every object
+            for index in range(len(obj_list)):
+                for name, stage in self.stages.items():
+                    if len(stage.after) == 0:
+                        submit(index, name)
+            with self.lock:
+                while self.outstanding > 0:
+                    self.finished.wait()
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=True)
+        return obj_list
+
+    # mark every stage downstream of a failed one as skipped for one object, returning how many were skipped
+    def skip_dependents(self, object_waiting, name):
+        skipped = 0
+        for dependent in self.dependents[name]:
+            if object_waiting[dependent] is not None:
+                object_waiting[dependent] = None
+                skipped += 1 + self.skip_dependents(object_waiting, dependent)
+        return skipped
@@ -0,0 +1,147 @@
+# One background poller for every outstanding response export/import. Instead of each job parking a worker thread in
+# a sleep loop, jobs are registered here and polled in batches on adaptive intervals; each job's Future completes
+# (firing its callbacks) when the job does
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+
+class PollJob:
+    """ one tracked job
+
+    Attributes:
+        name -- label for progress output
+        kind -- metrics poll name, e.g. "export_responses"
+        check -- function returning the job's latest progress result (a dict with "status"/"percentComplete"),
+                 raising if the job can't be checked
+        future -- completed with the final result, or with the exception if the job failed
+        interval -- seconds until the next check
+        started -- when the job was registered
+        lastPercent/lastCheck -- percentComplete and time of the previous check, to estimate time remaining
+    """
+    def __init__(self, name, kind, check, interval):
+        self.name = name
+        self.kind = kind
+        self.check = check
+        self.future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.interval = interval
+        self.started = time.monotonic()
+        self.lastPercent = None
+        self.lastCheck = None
+
+class JobFailed(Exception):
+    """ Exception raised when a tracked job reports a failed status
+
+    Attributes:
+        name -- the job's name
+        result -- the progress result that reported the failure
+    """
+    def __init__(self, name, result):
+        self.name = name
+        self.result = result
+
+    def __str__(self):
+        return '{name} failed: {result}'.format(name=self.name, result=self.result)
+
+class ProgressPoller:
+    """ polls every registered job from one scheduler thread
+
+    Checks start at minInterval and back off by backoff up to maxInterval. Once a job reports a rising
+    percentComplete, the next check is no later than its estimated completion time.
+
+    Attributes:
+        minInterval -- shortest wait between checks on a job
+        maxInterval -- longest wait between checks on a job
+        backoff -- factor the wait grows by after each check that isn't complete
+        workers -- how many checks may be in flight at once when several jobs are due together
+    """
+    def __init__(self, minInterval=1.0, maxInterval=30.0, backoff=1.5, workers=8):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poller")
+        self.due = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.thread = threading.Thread(target=self.loop, name="progress-poller", daemon=True)
+        self.thread.start()
+
+    # start tracking a job, returning a Future for its final progress result
+    def track(self, name, kind, check):
+        job = PollJob(name, kind, check, self.minInterval)
+        self.schedule(job, self.minInterval)
+        return job.future
+
+    def schedule(self, job, delay):
+        with self.lock:
+            heapq.heappush(self.due, (time.monotonic() + delay, next(self.counter), job))
+            self.wakeup.notify()
+
+    # scheduler thread: wait for the next due check, then hand every due job to the check workers as one batch
+    def loop(self):
+        while True:
+            with self.lock:
+                while not self.closed and (not self.due or self.due[0][0] > time.monotonic()):
+                    timeout = self.due[0][0] - time.monotonic() if self.due else None
+                    self.wakeup.wait(timeout)
+                if self.closed:
+                    return
+                batch = []
+                now = time.monotonic()
+                while self.due and self.due[0][0] <= now:
+                    batch.append(heapq.heappop(self.due)[2])
+            for job in batch:
+                self.executor.submit(self.poll, job)
+
+    # check one job and either finish it or schedule its next check
+    def poll(self, job):
+        try:
+            result = job.check()
+        except (Exception, SystemExit) as e:
+            self.finish(job, error=e)
+            return
+        status = result.get('status')
+        if status == "complete":
+            self.finish(job, result=result)
+            return
+        if status == "failed":
+            self.finish(job, error=JobFailed(job.name, result))
+            return
+        self.schedule(job, self.next_interval(job, result.get('percentComplete')))
+        return
+
+    # back off from the last interval, but don't wait past the job's estimated completion
+    def next_interval(self, job, percent):
+        now = time.monotonic()
+        interval = min(self.maxInterval, job.interval * self.backoff)
+        if percent is not None and job.lastPercent is not None and percent > job.lastPercent:
+            rate = (percent - job.lastPercent) / (now - job.lastCheck)
+            interval = min(interval, (100.0 - percent) / rate)
+        job.interval = max(self.minInterval, interval)
+        job.lastPercent = percent
+        job.lastCheck = now
+        print("Polling - {name} {pct}%, next check in {wait:.1f}s".format(name=job.name, pct=percent,
+                                                                          wait=job.interval))
+        return job.interval
+
+    def finish(self, job, result=None, error=None):
+        metrics.record_poll(job.kind, time.monotonic() - job.started)
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+        return
+
+    # stop the scheduler thread (jobs still outstanding are never completed)
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        return
@@ -1,15 +1,112 @@
 import requests
+import sessions
+import hashlib
 import json
 import os
+import threading
 
-# function to take a JSON object of data, and write it to a QSF file to be imported
-def write_to_qsf(data, survey_id, directory):
-    path = directory + survey_id + "_qsf.qsf"
-    with open(path, "w") as output_file:
-        json.dump(data, output_file)
-    return path
+# directory for the content-addressed QSF cache (None turns the cache off). Re-copying a survey that hasn't been
+# modified since it was cached skips the definition download
+QSF_CACHE_DIRECTORY = None
+QSF_MIME_TYPE = 'application/vnd.qualtrics.survey.qsf'
 
-# function to download a QSF (Qualtrics Survey Format) for the specified survey
+# the cache index (survey ID + last modified date -> QSF hash and survey name) is shared by every download thread
+_index_lock = threading.Lock()
+
+# function to pull the raw text of the top level "result" value out of an API response without re-serializing it.
+# Returns the parsed value (to read metadata from) and its exact text
+def result_slice(text):
+    decoder = json.JSONDecoder()
+    position = skip_whitespace(text, 0)
+    if text[position:position + 1] != "{":
+        raise ValueError("response is not a JSON object")
+    position = skip_whitespace(text, position + 1)
+    while text[position:position + 1] != "}":
+        key, position = decoder.raw_decode(text, position)
+        position = skip_whitespace(text, position)
+        if text[position:position + 1] != ":":
+            raise ValueError("expected ':' after key {key}".format(key=key))
+        start = skip_whitespace(text, position + 1)
+        value, position = decoder.raw_decode(text, start)
+        if key == "result":
+            return value, text[start:position]
+        position = skip_whitespace(text, position)
+        if text[position:position + 1] == ",":
+            position = skip_whitespace(text, position + 1)
+    raise ValueError("response has no result")
+
+def skip_whitespace(text, position):
+    while position < len(text) and text[position] in " \t\r\n":
+        position += 1
+    return position
+
+# function to look up when the source survey was last modified, which (with its ID) keys the QSF cache
+def last_modified(survey_id):
+    headers = {
+        "X-API-TOKEN": os.environ.get("source_api_token"),
+        "Content-Type": "application/json"
+    }
+    request_url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}".format(dc=os.environ.get("source_dc"), id=survey_id)
+    request = sessions.get_session(os.environ.get("source_dc")).get(request_url, headers=headers)
+    try:
+        request.raise_for_status()
+    except requests.exceptions.HTTPError as err:
+        print("Http error:", err)
+        raise SystemExit(err)
+    return json.loads(request.text)['result']['lastModifiedDate']
+
+def index_path():
+    return os.path.join(QSF_CACHE_DIRECTORY, "index.json")
+
+def blob_path(digest):
+    return os.path.join(QSF_CACHE_DIRECTORY, "blobs", digest + ".qsf")
+
+def read_index():
+    try:
+        with open(index_path()) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+# write to a temp file then swap it in, so an interrupted write never leaves a half written file behind
+def write_atomic(path, data, mode="wb"):
+    temp_path = "{path}.{thread}.tmp".format(path=path, thread=threading.get_ident())
+    with open(temp_path, mode) as output_file:
+        output_file.write(data)
+    os.replace(temp_path, path)
+    return
+
+# function to get a cached QSF for this version of the survey, returning (QSF bytes, survey name) or None
+def load_cached_qsf(cache_key):
+    with _index_lock:
+        entry = read_index().get(cache_key)
+    if entry is None:
+        return None
+    try:
+        with open(blob_path(entry['sha256']), 'rb') as qsf_file:
+            qsf_data = qsf_file.read()
+    except FileNotFoundError:
+        return None
+    # a corrupted blob is treated as a miss, it's overwritten by the fresh download
+    if hashlib.sha256(qsf_data).hexdigest() != entry['sha256']:
+        return None
+    return qsf_data, entry['surveyName']
+
+# function to add a QSF to the cache. Blobs are stored by the hash of their content, so unchanged definitions (e.g.
+# a survey touched without edits) share one file
+def store_qsf(cache_key, qsf_data, survey_name):
+    digest = hashlib.sha256(qsf_data).hexdigest()
+    os.makedirs(os.path.join(QSF_CACHE_DIRECTORY, "blobs"), exist_ok=True)
+    if not os.path.exists(blob_path(digest)):
+        write_atomic(blob_path(digest), qsf_data)
+    with _index_lock:
+        index = read_index()
+        index[cache_key] = {"sha256": digest, "surveyName": survey_name}
+        write_atomic(index_path(), json.dumps(index, indent=4), "w")
+    return
+
+# function to download a QSF (Qualtrics Survey Format) for the specified survey. The definition is kept in memory as
+# the exact bytes the API returned, for import_qsf to upload
 def download_qsf(obj):
     headers = {
         "X-API-TOKEN": os.environ.get("source_api_token"),
@@ -18,45 +115,70 @@ def download_qsf(obj):
     params = {
         'format': 'qsf'
     }
-    # set the survey ID from the object attribute 'sourceId', make API request
+    # already copied to every destination on an earlier run (from the manifest)
+    if not obj.qsfNeeded:
+        return
+    # set the survey ID from the object attribute 'sourceId'
     survey_id = obj.sourceId
+
+    # an unchanged survey that's already cached doesn't need downloading again
+    cache_key = None
+    if QSF_CACHE_DIRECTORY:
+        cache_key = "{id}|{modified}".format(id=survey_id, modified=last_modified(survey_id))
+        cached = load_cached_qsf(cache_key)
+        if cached is not None:
+            obj.qsfData, obj.surveyName = cached
+            return
+
     request_url = "https://{dc}.qualtrics.com/API/v3/survey-definitions/{id}".format(
         dc=os.environ.get("source_dc"), id=survey_id)
-    request = requests.get(request_url, headers=headers, params=params)
+    request = sessions.get_session(os.environ.get("source_dc")).get(request_url, headers=headers, params=params)
+    # catch non-200 response (e.g. still throttled after retries) before reading the result
+    try:
+        request.raise_for_status()
+    except requests.exceptions.HTTPError as err:
+        print("Http error:", err)
+        raise SystemExit(err)
     try:
-        request_obj = json.loads(request.text)
+        qsf_result, qsf_text = result_slice(request.text)
     except ValueError as ve:
         print("The qsf data is not valid JSON")
         raise
 
-    # create a QSF file from the output of the API call, add to directory for files
-    directory = '/Users/esegerberg/PycharmProjects/PublishingTesting/qsf_files/'
-    qsf_data = request_obj['result']
-    survey_name = request_obj['result']['SurveyEntry']['SurveyName']
-    obj.surveyName = survey_name
-
-    # call function to create a QSF file for the given survey in the specified directory
-    qsf_path = write_to_qsf(qsf_data, survey_id, directory)
-    obj.qsfPath = qsf_path
+    # keep the QSF exactly as it came back, and only the survey name out of everything that was parsed
+    obj.surveyName = qsf_result['SurveyEntry']['SurveyName']
+    obj.qsfData = qsf_text.encode("utf-8")
+    if cache_key is not None:
+        store_qsf(cache_key, obj.qsfData, obj.surveyName)
     return
 
-def import_qsf(obj):
-    qsf_path = obj.qsfPath
+# function to create the survey in one destination brand from the downloaded QSF
+def import_qsf(obj, destination):
+    # already copied on an earlier run (from the manifest), the responses are appended to the existing survey
+    if destination['name'] in obj.destIds:
+        return
     survey_name = obj.surveyName
     files = {
-        'file': (qsf_path, open(qsf_path, 'rb'), 'application/vnd.qualtrics.survey.qsf')
+        'file': (obj.sourceId + "_qsf.qsf", obj.qsfData, QSF_MIME_TYPE)
     }
 
     headers = {
-        "X-API-TOKEN": os.environ.get("dest_api_token")
+        "X-API-TOKEN": destination['apiToken']
     }
 
     data = {
         "name": survey_name + " - new"
     }
 
-    request_url = "https://{dc}.qualtrics.com/API/v3/surveys".format(dc=os.environ.get("dest_dc"))
-    response = requests.post(request_url, files=files, data=data, headers=headers)
+    request_url = "https://{dc}.qualtrics.com/API/v3/surveys".format(dc=destination['dataCenter'])
+    response = sessions.get_session(destination['dataCenter']).post(request_url, files=files, data=data,
+                                                                   headers=headers)
+    # catch non-200 response before reading the new survey's ID
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as err:
+        print("Http error:", err)
+        raise SystemExit(err)
     dest_id = json.loads(response.text)['result']['id']
-    obj.destId = dest_id
-    return
\ No newline at end of file
+    obj.destIds[destination['name']] = dest_id
+    return
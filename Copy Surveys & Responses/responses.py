@@ -1,9 +1,54 @@
 import requests
+import sessions
+import poller
 import json
+import csv
 import io, os
+import shutil
 import zipfile
-import time
-import datetime
+import threading
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# directory the exported response files are unzipped to
+RESPONSE_DIRECTORY = ""
+# time zone the export's dates are written in
+EXPORT_TIME_ZONE = "America/Denver"
+# size of the chunks exports are downloaded and unzipped in, so memory use doesn't grow with the export size
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+# if True, the export stays zipped on disk and its CSV is streamed straight out of the zip into the import
+PIPE_EXPORT_TO_IMPORT = False
+# if set, a survey with more responses than this is split into CSVs of this many rows, each imported as its own job
+IMPORT_CHUNK_ROWS = 0
+# how many chunk imports of one survey may run at once, and how many times a failed chunk is retried
+IMPORT_CHUNK_WORKERS = 4
+IMPORT_CHUNK_RETRIES = 2
+# header rows at the top of a labelled CSV export (column names, labels, import IDs), repeated in every chunk
+CSV_HEADER_ROWS = 3
+# shortest and longest wait (seconds) between progress checks on response exports and imports
+POLL_MIN_SECONDS = 1
+POLL_MAX_SECONDS = 30
+
+# one progress poller shared by every export/import, created on first use
+_poller = None
+_poller_lock = threading.Lock()
+
+def get_poller():
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = poller.ProgressPoller(minInterval=POLL_MIN_SECONDS, maxInterval=POLL_MAX_SECONDS)
+    return _poller
+
+# stop the shared poller, e.g. at the end of a run
+def close_poller():
+    global _poller
+    with _poller_lock:
+        if _poller is not None:
+            _poller.close()
+            _poller = None
+    return
 
 # defining global variable for headers since is used by multiple API endpoints
 def get_headers(loc_type):
@@ -13,21 +58,27 @@ def get_headers(loc_type):
         "Content-Type": "application/json"
     }
     return headers
-# function to kick off response export process
-def start_export(survey_id):
-    # setting the headers for this function, which will use the source brand API token
-    headers = get_headers("source")
-    url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses".format(
-        dc=os.environ.get("source_dc"), id=survey_id)
-
+# the body of an export request, optionally only for responses recorded after start_date (ISO 8601)
+def export_body(start_date=None):
     data = {
         "format": "csv",
-        "timeZone": "America/Denver",
+        "timeZone": EXPORT_TIME_ZONE,
         "useLabels": True,
         "breakoutSets" : False
     }
+    if start_date:
+        data["startDate"] = start_date
+    return json.dumps(data)
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+# function to kick off response export process, optionally only for responses recorded after start_date
+def start_export(survey_id, start_date=None):
+    # setting the headers for this function, which will use the source brand API token
+    headers = get_headers("source")
+    url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses".format(
+        dc=os.environ.get("source_dc"), id=survey_id)
+
+    response = sessions.get_session(os.environ.get("source_dc")).post(url, headers=headers,
+                                                                     data=export_body(start_date))
     # catch non-200 response before polling for progress
     try:
         response.raise_for_status()
@@ -49,7 +100,7 @@ def export_progress(survey_id, progress_id):
     url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses/{progress}".format(
         dc=os.environ.get("source_dc"), id=survey_id, progress=progress_id)
 
-    response = requests.get(url, headers=headers)
+    response = sessions.get_session(os.environ.get("source_dc")).get(url, headers=headers)
     # catch non-200 responses
     try:
         response.raise_for_status()
@@ -60,50 +111,172 @@ def export_progress(survey_id, progress_id):
     # return response output text
     return response.text
 
-# function to complete the export and return the file path to the export
-def get_export_file(obj):
+# function to start a survey's export and hand it to the shared poller. Returns a Future that completes (with the
+# export's fileId saved to the object) once the export file is ready, without holding a thread while it waits
+def request_export(obj):
+    # grab the source survey ID of the object, start the export process (only for responses newer than the last
+    # copy, if the survey has been copied before)
+    survey_id = obj.sourceId
+    progress_id = json.loads(start_export(survey_id, obj.lastResponseDate))['result']['progressId']
+
+    def check():
+        return json.loads(export_progress(survey_id, progress_id))['result']
+
+    def save_file_id(future):
+        if future.exception() is None:
+            obj.exportFileId = future.result()['fileId']
+
+    future = get_poller().track("export " + survey_id, "export_responses", check)
+    future.add_done_callback(save_file_id)
+    return future
+
+# function to download a finished export and save the file path to the object
+def download_export(obj):
     # setting the headers for this function, which will use the source brand API token
     headers = get_headers("source")
-    # grab the source survey ID of the object, start the export process
     survey_id = obj.sourceId
-    progress_id = json.loads(start_export(survey_id))['result']['progressId']
-    # keep polling for progress until progress call returns a status of "complete"
-    file_id = ""
-    status = ""
-    while status != "complete":
-        response = export_progress(survey_id, progress_id)
-        # get the status of the progress poll from the response
-        response_json = json.loads(response)
-        status = response_json['result']['status']
-        # large exports can take a bit, so pause in between requests
-        if status != "complete":
-            ct = datetime.datetime.now()
-            print("Sleeping - " + ct)
-            time.sleep(5)
+    export_file_url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses/{fileId}/file".format(
+        dc=os.environ.get("source_dc"), id=survey_id, fileId=obj.exportFileId)
+
+    zip_path = export_zip_path(obj)
+
+    # stream the zip to disk a chunk at a time rather than holding the whole export in memory
+    with sessions.get_session(os.environ.get("source_dc")).get(export_file_url, headers=headers,
+                                                                stream=True) as request_download:
+        try:
+            request_download.raise_for_status()
+        except requests.exceptions.HTTPError as err:
+            print("Http error:", err)
+            raise SystemExit(err)
+        with open(zip_path, 'wb') as zip_output:
+            for chunk in request_download.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+                zip_output.write(chunk)
+    unpack_export(obj, zip_path)
+    return
+
+# file path the export zip is downloaded to, in a folder per source survey (so surveys with the same name don't
+# overwrite each other's files)
+def export_zip_path(obj):
+    directory_path = os.path.join(RESPONSE_DIRECTORY, obj.sourceId)
+    os.makedirs(directory_path, exist_ok=True)
+    return os.path.join(directory_path, obj.exportFileId + ".zip")
+
+# function to unzip a downloaded export (unless it's piped into the import) and save its file path to the object
+def unpack_export(obj, zip_path):
+    directory_path = os.path.dirname(zip_path)
+    # the actual file is the CSV inside the zip (named after the survey), so the export doesn't depend on
+    # download_qsf having already looked up the survey name
+    with zipfile.ZipFile(zip_path) as zip_file:
+        member = zip_file.namelist()[0]
+        if PIPE_EXPORT_TO_IMPORT:
+            # leave it zipped, the import reads the CSV straight out of the zip
+            obj.responsePath = zip_path
+            obj.responseMember = member
         else:
-            # if it's complete, grab the file ID for the final API call
-            file_id = response_json['result']['fileId']
+            # unzip the CSV to the specified directory as a stream, then the zip is no longer needed
+            obj.responsePath = os.path.join(directory_path, os.path.basename(member))
+            with zip_file.open(member) as csv_input, open(obj.responsePath, 'wb') as csv_output:
+                shutil.copyfileobj(csv_input, csv_output, DOWNLOAD_CHUNK_BYTES)
+    if not PIPE_EXPORT_TO_IMPORT:
+        os.remove(zip_path)
+    # the newest response in the file becomes the survey's copy watermark once it's imported
+    obj.newestResponseDate, obj.newestResponseIds = newest_recorded_date(obj)
+    return
 
-    export_file_url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses/{fileId}/file".format(
-        dc=os.environ.get("source_dc"), id=survey_id, fileId=file_id)
-    request_download = requests.get(export_file_url, headers=headers, stream=True)
-
-    # file path where the unzipped files will go, save to the SurveyObject
-    directory_path = ""
-    # the actual file path will be the directory + the name of the original survey. Save that to the object
-    survey_name = obj.surveyName
-    obj.responsePath = directory_path + "/" + survey_name + ".csv"
-    # unzip the downloaded file to the specified directory
-    zipfile.ZipFile(io.BytesIO(request_download.content)).extractall(path=directory_path)
+# function to find the newest RecordedDate in the exported CSV (streamed, one row at a time), as an ISO 8601 UTC
+# string for the next export's startDate, and the ResponseIds recorded in that second. The export's dates are whole
+# seconds, so the IDs are what tells a response from a later run's export apart in the watermark's second. Returns
+# (None, []) if the export has no responses
+def newest_recorded_date(obj):
+    newest = None
+    newest_ids = []
+    with open_response_text(obj.responsePath, obj.responseMember) as csv_input:
+        reader = csv.reader(csv_input)
+        header = [row for _, row in zip(range(CSV_HEADER_ROWS), reader)]
+        column = header[0].index("RecordedDate")
+        response_id = header[0].index("ResponseId")
+        for row in reader:
+            # the dates are zero padded "YYYY-MM-DD HH:MM:SS", so they sort as strings
+            if newest is None or row[column] > newest:
+                newest = row[column]
+                newest_ids = []
+            if row[column] == newest:
+                newest_ids.append(row[response_id])
+    if newest is None:
+        return None, []
+    return recorded_date_utc(newest), newest_ids
+
+# convert a RecordedDate from the export (in EXPORT_TIME_ZONE) to an ISO 8601 UTC string
+def recorded_date_utc(value):
+    recorded = datetime.strptime(value, "%Y-%m-%d %H:%M:%S").replace(tzinfo=ZoneInfo(EXPORT_TIME_ZONE))
+    return recorded.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# function to complete the export and return the file path to the export (blocking, for the stage-by-stage runner)
+def get_export_file(obj):
+    # the fileId is taken from the result itself: result() can return before the done callback has saved it
+    obj.exportFileId = request_export(obj).result()['fileId']
+    download_export(obj)
     return
 
-def check_import(survey_id, progress_id):
-    # setting the headers for this function, which will use the source brand API token
-    headers = get_headers("dest")
+class ZipMemberReader:
+    """ file-like reader streaming one file out of a zip, used as an upload body. Its length is the uncompressed
+    size, so the upload still sends a Content-Length
+
+    Attributes:
+        zipPath -- file path of the zip
+        member -- name of the file inside the zip
+        size -- uncompressed size of the member
+    """
+    def __init__(self, zipPath, member):
+        self.zipPath = zipPath
+        self.member = member
+        self.zipFile = zipfile.ZipFile(zipPath)
+        self.size = self.zipFile.getinfo(member).file_size
+        self.stream = self.zipFile.open(member)
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    # only rewinding to the start is supported (for a retried upload), which reopens the member
+    def seek(self, offset, whence=0):
+        self.stream.close()
+        self.stream = self.zipFile.open(self.member)
+        return 0
+
+    def close(self):
+        self.stream.close()
+        self.zipFile.close()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# the import request body, streamed from disk (or out of the export zip when piping) instead of read into memory
+def open_response_body(path, member=""):
+    if member:
+        return ZipMemberReader(path, member)
+    return open(path, 'rb')
+
+# headers for calls to a destination brand
+def dest_headers(destination, content_type="application/json"):
+    return {
+        "X-API-TOKEN": destination['apiToken'],
+        "Content-Type": content_type
+    }
+
+def check_import(survey_id, progress_id, destination):
+    # setting the headers for this function, which will use the destination brand's API token
+    headers = dest_headers(destination)
     # make request to check the import status
     url = "https://{dc}.qualtrics.com/API/v3/surveys/{survey_id}/import-responses/{progress_id}".format(
-        dc=os.environ.get("dest_dc"), survey_id=survey_id, progress_id=progress_id)
-    request = requests.get(url, headers=headers)
+        dc=destination['dataCenter'], survey_id=survey_id, progress_id=progress_id)
+    request = sessions.get_session(destination['dataCenter']).get(url, headers=headers)
     # catch non-200 response
     try:
         request.raise_for_status()
@@ -113,23 +286,14 @@ def check_import(survey_id, progress_id):
         raise SystemExit(err)
     return request.text
 
-def start_import(obj):
-    # pull the needed params from the objects attributes
-    file_path = obj.responsePath
-    survey_id = obj.destId
+# function to post a CSV body to a destination survey's import endpoint, returning the import's progress ID
+def post_import(survey_id, data, destination):
+    headers = dest_headers(destination, "text/csv; charset=UTF-8")
 
-    headers = {
-        "X-API-TOKEN": os.environ.get("dest_api_token"),
-        "Content-Type": "text/csv; charset=UTF-8"
-    }
-
-    # set body for request
-    data = open(file_path, 'rb').read()
-
-    # start the import process
+    # start the import process, the body is streamed from the file so memory stays flat whatever its size
     url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/import-responses".format(
-        dc=os.environ.get("dest_dc"), id=survey_id)
-    request = requests.post(url, headers=headers, data=data)
+        dc=destination['dataCenter'], id=survey_id)
+    request = sessions.get_session(destination['dataCenter']).post(url, headers=headers, data=data)
 
     # catch non-200 response before polling for progress
     try:
@@ -139,22 +303,220 @@ def start_import(obj):
         print("Http error:", err)
         raise SystemExit(err)
 
-    # get the progress ID so can poll for progress until import is complete
+    # get the progress ID so the poller can check progress until import is complete
     output = json.loads(request.text)
-    progress_id = output['result']['progressId']
-    status = ""
-
-    # loop and check import progress until it is complete
-    while status != "complete":
-        response = check_import(survey_id, progress_id)
-        # get the status of the progress poll from the response
-        response_json = json.loads(response)
-        status = response_json['result']['status']
-        # large exports can take a bit, so pause in between progress requests
-        if status != "complete":
-            ct = datetime.datetime.now()
-            print("Sleeping - " + ct)
-            print()
-            time.sleep(10)
-    print("Finished the import for {id}".format(id=survey_id))
+    return output['result']['progressId']
+
+# function to hand a started import to the shared poller, returning a Future for its final progress result
+def track_import(survey_id, progress_id, name, destination):
+    def check():
+        return json.loads(check_import(survey_id, progress_id, destination))['result']
+
+    return get_poller().track(name, "import_responses", check)
+
+# whether a response (RecordedDate as ISO 8601 UTC) hasn't been copied to a destination whose watermark is since,
+# with copied_ids the ResponseIds it already has from the watermark's second. Without those IDs (a manifest written
+# before they were kept) the whole second counts as copied
+def is_new_response(recorded, response_id, since, copied_ids=None):
+    if since is None or recorded > since:
+        return True
+    return recorded == since and copied_ids is not None and response_id not in copied_ids
+
+# function to pick the file to import into one destination, returning (path, zip member) or None if it has nothing
+# new. Unless nothing has been copied there yet, the responses the destination already has are always dropped here:
+# the export's startDate can't be relied on to leave them out (it starts at the oldest watermark of all the
+# destinations, its dates are whole seconds, and it may include the boundary)
+def import_source(obj, destination):
+    if obj.newestResponseDate is None:
+        return None
+    name = destination['name']
+    since = obj.lastResponseDates.get(name)
+    if since is None:
+        return obj.responsePath, obj.responseMember
+    path = os.path.join(RESPONSE_DIRECTORY, obj.sourceId, name + "_new.csv")
+    if filter_responses(obj, since, path, obj.lastResponseIds.get(name)) == 0:
+        os.remove(path)
+        return None
+    return path, ""
+
+# function to copy the export's responses a destination doesn't have yet (see is_new_response) to a new CSV,
+# returning how many
+def filter_responses(obj, since, path, copied_ids=None):
+    kept = 0
+    with open_response_text(obj.responsePath, obj.responseMember) as csv_input, \
+            open(path, 'w', encoding="utf-8", newline="") as csv_output:
+        reader = csv.reader(csv_input)
+        writer = csv.writer(csv_output)
+        header = [row for _, row in zip(range(CSV_HEADER_ROWS), reader)]
+        writer.writerows(header)
+        column = header[0].index("RecordedDate")
+        response_id = header[0].index("ResponseId")
+        for row in reader:
+            if is_new_response(recorded_date_utc(row[column]), row[response_id], since, copied_ids):
+                writer.writerow(row)
+                kept += 1
+    return kept
+
+# function to start the import of a survey's responses into one destination and hand it to the shared poller.
+# Returns a Future that completes once the import has finished. With IMPORT_CHUNK_ROWS set, large files are imported
+# in chunks instead (which blocks until every chunk has finished, so nothing is returned)
+def request_import(obj, destination):
+    # pull the needed params from the objects attributes
+    survey_id = obj.destIds[destination['name']]
+    # nothing new since the last copy (or an empty survey), there's nothing to append
+    source = import_source(obj, destination)
+    if source is None:
+        print("No new responses to import for {id}".format(id=survey_id))
+        return
+    path, member = source
+    try:
+        if IMPORT_CHUNK_ROWS:
+            chunk_dir = os.path.join(RESPONSE_DIRECTORY, obj.sourceId, "chunks", destination['name'])
+            chunks = split_responses(path, member, chunk_dir, IMPORT_CHUNK_ROWS)
+            if len(chunks) > 1:
+                import_chunks(survey_id, chunks, destination)
+                return
+            # small enough to go in one import
+            os.remove(chunks[0][0])
+
+        with open_response_body(path, member) as data:
+            progress_id = post_import(survey_id, data, destination)
+    finally:
+        # a destination's own filtered copy is only needed until it's been sent
+        if path != obj.responsePath:
+            os.remove(path)
+
+    def report(future):
+        if future.exception() is None:
+            print("Finished the import for {id}".format(id=survey_id))
+
+    future = track_import(survey_id, progress_id, "import " + survey_id, destination)
+    future.add_done_callback(report)
+    return future
+
+# function to import the responses and wait for the import to finish (blocking, for the stage-by-stage runner)
+def start_import(obj, destination):
+    future = request_import(obj, destination)
+    if future is not None:
+        future.result()
+    return
+
+# function to add the export's responses to the local response archive (Shared/archive.py), for the validator and
+# later copy verifications to read instead of calling the API. The CSV is streamed into it, RecordedDate in UTC
+def archive_export(obj, response_archive):
+    if obj.newestResponseDate is None:
+        return
+    with open_response_text(obj.responsePath, obj.responseMember) as csv_input:
+        reader = csv.reader(csv_input)
+        header = [row for _, row in zip(range(CSV_HEADER_ROWS), reader)]
+        recorded = header[0].index("RecordedDate")
+
+        def utc_rows():
+            for row in reader:
+                row[recorded] = recorded_date_utc(row[recorded])
+                yield row
+
+        count = response_archive.append(obj.sourceId, header[0], utc_rows())
+    print("Archived {count} responses for {id}".format(count=count, id=obj.sourceId))
+    return
+
+# function to delete a piped export's zip once every destination has imported from it
+def remove_export(obj):
+    if obj.responseMember and os.path.exists(obj.responsePath):
+        os.remove(obj.responsePath)
+    return
+
+# function to open the exported CSV as text for the csv module, whether it's unzipped or still in the export zip
+def open_response_text(path, member=""):
+    if member:
+        with zipfile.ZipFile(path) as zip_file:
+            raw = zip_file.open(member)
+    else:
+        raw = open(path, 'rb')
+    # utf-8-sig drops the byte order mark the export starts with, so the first column name reads cleanly
+    return io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+
+# function to split an exported CSV into files of at most chunk_rows responses in chunk_dir, each starting with the
+# export's header rows. Parsed with the csv module, so responses with line breaks inside a quoted answer stay whole.
+# Returns a list of (chunk file path, number of responses in it)
+def split_responses(path, member, chunk_dir, chunk_rows):
+    os.makedirs(chunk_dir, exist_ok=True)
+    chunks = []
+    chunk_file = None
+    writer = None
+    try:
+        with open_response_text(path, member) as csv_input:
+            reader = csv.reader(csv_input)
+            header = [row for _, row in zip(range(CSV_HEADER_ROWS), reader)]
+            for row in reader:
+                if writer is None or chunks[-1][1] == chunk_rows:
+                    if chunk_file is not None:
+                        chunk_file.close()
+                    chunk_path = os.path.join(chunk_dir, "{n:05d}.csv".format(n=len(chunks)))
+                    chunk_file = open(chunk_path, 'w', encoding="utf-8", newline="")
+                    writer = csv.writer(chunk_file)
+                    writer.writerows(header)
+                    chunks.append([chunk_path, 0])
+                writer.writerow(row)
+                chunks[-1][1] += 1
+    finally:
+        if chunk_file is not None:
+            chunk_file.close()
+    # an export with no responses is still imported (as just its header)
+    if not chunks:
+        chunk_path = os.path.join(chunk_dir, "00000.csv")
+        with open(chunk_path, 'w', encoding="utf-8", newline="") as chunk_file:
+            csv.writer(chunk_file).writerows(header)
+        chunks.append([chunk_path, 0])
+    return [tuple(chunk) for chunk in chunks]
+
+# function to import one chunk file and wait for it. The chunk is only posted again if the server turned the post
+# away without starting an import (a 429/503, or no connection could be made). A post that failed any other way may
+# still have started one, and once started a failed progress check just checks the same import again: posting it a
+# second time could import its responses twice. An import the server reports as failed isn't retried
+def import_chunk(survey_id, chunk_path, name, destination):
+    progress_id = None
+    for attempt in range(IMPORT_CHUNK_RETRIES + 1):
+        try:
+            if progress_id is None:
+                with open(chunk_path, 'rb') as data:
+                    progress_id = post_import(survey_id, data, destination)
+            track_import(survey_id, progress_id, name, destination).result()
+            return
+        except poller.JobFailed:
+            raise
+        except (Exception, SystemExit) as err:
+            # post_import exits with the HTTPError it caught
+            cause = err.args[0] if isinstance(err, SystemExit) and err.args else err
+            if attempt == IMPORT_CHUNK_RETRIES or (progress_id is None and not sessions.post_can_resend(cause)):
+                raise
+            print("{name} failed ({err}), retrying".format(name=name, err=repr(err)))
+
+# function to import a survey's chunks, IMPORT_CHUNK_WORKERS at a time, then check every chunk's import finished.
+# The import progress doesn't report how many responses were imported, so the counts printed are the responses
+# sent (VERIFY_COPIES in main.py checks what the destination actually holds)
+def import_chunks(survey_id, chunks, destination):
+    total_rows = sum(rows for _, rows in chunks)
+    imported_rows = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=IMPORT_CHUNK_WORKERS, thread_name_prefix="import_chunk") as executor:
+        futures = {executor.submit(import_chunk, survey_id, path,
+                                   "import {id} chunk {n}/{total}".format(id=survey_id, n=n + 1, total=len(chunks)),
+                                   destination):
+                   (path, rows) for n, (path, rows) in enumerate(chunks)}
+        for future in as_completed(futures):
+            path, rows = futures[future]
+            if future.exception() is not None:
+                failed.append(path)
+                continue
+            imported_rows += rows
+            os.remove(path)
+            print("Imported {done}/{total} responses for {id}".format(done=imported_rows, total=total_rows,
+                                                                      id=survey_id))
+    # failed chunk files are left on disk so they can be imported by hand
+    if failed:
+        raise SystemExit("Chunked import for {id} sent {done} of {total} responses, failed chunks: {failed}".format(
+            id=survey_id, done=imported_rows, total=total_rows, failed=failed))
+    print("Finished the import for {id}, {total} responses in {n} chunks".format(id=survey_id, total=total_rows,
+                                                                                 n=len(chunks)))
     return
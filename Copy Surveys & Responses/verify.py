@@ -0,0 +1,222 @@
+# Post-copy check that each destination survey really holds the responses imported into it. The destination's
+# responses are exported and streamed, and compared with the source export already on disk by their count and an
+# order independent sum of per-response hashes, so memory stays flat whatever the survey size. The responses that
+# are missing or different are only worked out (and written to a file) when the totals don't match.
+# Imported responses get new IDs, so responses are hashed on their answers/metadata, never on ResponseId
+import requests
+import sessions
+import responses
+import csv
+import hashlib
+import json
+import os
+import zipfile
+
+# columns hashed for each response. None uses every column of the source export except VERIFY_SKIP_COLUMNS
+VERIFY_COLUMNS = None
+# columns the destination brand sets itself when responses are imported
+VERIFY_SKIP_COLUMNS = ("ResponseId", "RecordedDate")
+# the hashes are added up modulo 2^128, so the total doesn't depend on the order the export lists responses in
+DIGEST_BITS = 128
+# missing/different responses printed per survey, the full list is written to the verification file
+REPORT_LIMIT = 10
+
+# function to start an export of a destination survey's responses, returning the export's progress ID
+def start_dest_export(survey_id, destination):
+    url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses".format(
+        dc=destination['dataCenter'], id=survey_id)
+    response = sessions.get_session(destination['dataCenter']).post(url, headers=responses.dest_headers(destination),
+                                                                    data=responses.export_body())
+    # catch non-200 response before polling for progress
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as err:
+        print("Http error:", err)
+        raise SystemExit(err)
+    return json.loads(response.text)['result']['progressId']
+
+# function to check the progress of a destination survey's export
+def dest_export_progress(survey_id, progress_id, destination):
+    url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses/{progress}".format(
+        dc=destination['dataCenter'], id=survey_id, progress=progress_id)
+    response = sessions.get_session(destination['dataCenter']).get(url, headers=responses.dest_headers(destination))
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError as err:
+        print("Http error:", err)
+        raise SystemExit(err)
+    return json.loads(response.text)['result']
+
+# whether this run imported anything into the destination (the same test import_source uses to skip it)
+def has_new_responses(obj, name):
+    since = obj.lastResponseDates.get(name)
+    copied_ids = obj.lastResponseIds.get(name)
+    return obj.newestResponseDate is not None and any(
+        responses.is_new_response(obj.newestResponseDate, response_id, since, copied_ids)
+        for response_id in obj.newestResponseIds)
+
+# what the destination held before this run's import, as recorded by its last verification, or None if that isn't
+# known (copied before verification was turned on, or verified on different columns). A destination nothing has
+# been imported into yet starts empty
+def baseline(obj, name, columns):
+    if obj.lastResponseDates.get(name) is None:
+        return {"responses": 0, "digest": format(0, "032x"), "columns": columns}
+    previous = obj.verifications.get(name)
+    if previous is None or previous['columns'] != columns:
+        return None
+    return previous
+
+# whether the destination needs verifying: not if nothing was imported and it was already verified, as it can't
+# have changed
+def needs_verify(obj, name):
+    return has_new_responses(obj, name) or name not in obj.verifications
+
+# function to start exporting the destination survey once its import has finished, for verify_import to compare.
+# Returns a Future that completes once the export file is ready, or None if there's nothing to verify
+def request_verify(obj, destination):
+    name = destination['name']
+    if not needs_verify(obj, name):
+        return None
+    survey_id = obj.destIds[name]
+    progress_id = start_dest_export(survey_id, destination)
+
+    def save_file_id(future):
+        if future.exception() is None:
+            obj.verifyFileIds[name] = future.result()['fileId']
+
+    future = responses.get_poller().track("verify export " + survey_id, "verify_export",
+                                          lambda: dest_export_progress(survey_id, progress_id, destination))
+    future.add_done_callback(save_file_id)
+    return future
+
+# function to download a destination survey's finished export, returning the path of the zip
+def download_dest_export(obj, destination):
+    name = destination['name']
+    survey_id = obj.destIds[name]
+    url = "https://{dc}.qualtrics.com/API/v3/surveys/{id}/export-responses/{fileId}/file".format(
+        dc=destination['dataCenter'], id=survey_id, fileId=obj.verifyFileIds[name])
+    zip_path = os.path.join(responses.RESPONSE_DIRECTORY, obj.sourceId, "verify_" + name + ".zip")
+    # streamed to disk like the source export, it's read straight out of the zip
+    with sessions.get_session(destination['dataCenter']).get(url, headers=responses.dest_headers(destination),
+                                                             stream=True) as request_download:
+        try:
+            request_download.raise_for_status()
+        except requests.exceptions.HTTPError as err:
+            print("Http error:", err)
+            raise SystemExit(err)
+        with open(zip_path, 'wb') as zip_output:
+            for chunk in request_download.iter_content(chunk_size=responses.DOWNLOAD_CHUNK_BYTES):
+                zip_output.write(chunk)
+    return zip_path
+
+# the hash of one response's values in the given columns, as an integer (a column the file doesn't have is blank)
+def response_digest(row, positions):
+    values = [row[i] if i is not None and i < len(row) else "" for i in positions]
+    digest = hashlib.blake2b("\x1f".join(values).encode("utf-8"), digest_size=DIGEST_BITS // 8).digest()
+    return int.from_bytes(digest, "big")
+
+# yield (ResponseId, hash) for each response in an exported CSV (streamed, one row at a time). With since set, only
+# the responses import_source sends to a destination with that watermark (and copied_ids) are included
+def response_digests(path, member, columns, since=None, copied_ids=None):
+    with responses.open_response_text(path, member) as csv_input:
+        reader = csv.reader(csv_input)
+        header = [row for _, row in zip(range(responses.CSV_HEADER_ROWS), reader)][0]
+        positions = [header.index(column) if column in header else None for column in columns]
+        response_id = header.index("ResponseId")
+        recorded = header.index("RecordedDate")
+        for row in reader:
+            if not responses.is_new_response(responses.recorded_date_utc(row[recorded]), row[response_id], since,
+                                             copied_ids):
+                continue
+            yield row[response_id], response_digest(row, positions)
+
+# the response count and the sum of the response hashes, the same for any order the responses come in
+def aggregate(digests):
+    count = 0
+    total = 0
+    for response_id, digest in digests:
+        count += 1
+        total = (total + digest) % (1 << DIGEST_BITS)
+    return count, total
+
+# the columns hashed for a survey, from the source export's column names
+def verify_columns(obj):
+    if VERIFY_COLUMNS is not None:
+        return list(VERIFY_COLUMNS)
+    with responses.open_response_text(obj.responsePath, obj.responseMember) as csv_input:
+        header = next(csv.reader(csv_input))
+    return [column for column in header if column not in VERIFY_SKIP_COLUMNS]
+
+# function to find which of this run's source responses aren't in the destination export (missing, or imported
+# with different values). Only called after the totals disagree: it holds the source responses' hashes in memory
+def find_differences(obj, since, copied_ids, zip_path, member, columns):
+    expected = {}
+    for response_id, digest in response_digests(obj.responsePath, obj.responseMember, columns, since, copied_ids):
+        expected.setdefault(digest, []).append(response_id)
+    for response_id, digest in response_digests(zip_path, member, columns):
+        matches = expected.get(digest)
+        if matches:
+            matches.pop()
+    return sorted(response_id for ids in expected.values() for response_id in ids)
+
+# write the source ResponseIds that didn't verify to a CSV next to the export, returning its path
+def write_differences(obj, name, response_ids):
+    path = os.path.join(responses.RESPONSE_DIRECTORY, obj.sourceId, "verify_" + name + ".csv")
+    with open(path, 'w', encoding="utf-8", newline="") as csv_output:
+        writer = csv.writer(csv_output)
+        writer.writerow(["ResponseId"])
+        writer.writerows([response_id] for response_id in response_ids)
+    return path
+
+# function to compare the destination's finished export with what should be there: its last verified totals plus
+# this run's source responses for it. The destination's totals are saved to the object (and so to the manifest) as
+# the next run's baseline whether or not they matched, a mismatch is reported rather than raised so the copy is
+# still recorded and its responses aren't imported a second time
+def verify_import(obj, destination):
+    name = destination['name']
+    if not needs_verify(obj, name):
+        return
+    survey_id = obj.destIds[name]
+    if name not in obj.verifyFileIds:
+        print("No export file ID for {id} in {name}, it couldn't be verified".format(id=survey_id, name=name))
+        return
+    since = obj.lastResponseDates.get(name)
+    copied_ids = obj.lastResponseIds.get(name)
+    columns = verify_columns(obj)
+    zip_path = download_dest_export(obj, destination)
+    try:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            member = zip_file.namelist()[0]
+        actual_count, actual_total = aggregate(response_digests(zip_path, member, columns))
+        new_count, new_total = aggregate(response_digests(obj.responsePath, obj.responseMember, columns, since,
+                                                      copied_ids))
+        before = baseline(obj, name, columns)
+        obj.verifications[name] = {"responses": actual_count, "digest": format(actual_total, "032x"),
+                                   "columns": columns}
+        if before is None:
+            print("No verification baseline for {id} in {name}, recorded {count} responses as the baseline".format(
+                id=survey_id, name=name, count=actual_count))
+            return
+        expected_count = before['responses'] + new_count
+        expected_total = (int(before['digest'], 16) + new_total) % (1 << DIGEST_BITS)
+        if (actual_count, actual_total) == (expected_count, expected_total):
+            print("Verified {id} in {name}: {count} responses".format(id=survey_id, name=name, count=actual_count))
+            return
+        differences = find_differences(obj, since, copied_ids, zip_path, member, columns)
+        path = write_differences(obj, name, differences)
+        print("Verification failed for {id} in {name}: expected {expected} responses, found {actual}. "
+              "{n} source responses missing or different (listed in {path}): {sample}".format(
+                  id=survey_id, name=name, expected=expected_count, actual=actual_count, n=len(differences),
+                  path=path, sample=", ".join(differences[:REPORT_LIMIT])))
+    finally:
+        os.remove(zip_path)
+    return
+
+# function to export the destination and verify it (blocking, for the stage-by-stage runner and the asyncio engine)
+def verify_copy(obj, destination):
+    future = request_verify(obj, destination)
+    if future is not None:
+        # taken from the result itself: result() can return before the done callback has saved the file ID
+        obj.verifyFileIds[destination['name']] = future.result()['fileId']
+    verify_import(obj, destination)
+    return
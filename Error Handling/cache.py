@@ -0,0 +1,93 @@
+# On-disk cache of ticket and response payloads, so reruns and overlapping run windows of the validator read
+# locally instead of calling the API again
+import sqlite3
+import threading
+import time
+import json
+
+class PayloadCache:
+    """ SQLite cache of API payloads, shared by every survey/thread in a run
+
+    Each entry is keyed by kind ("ticket"/"response") and key (ticket key/responseId) and stores the version it
+    was fetched at (the ticket's last-modified timestamp). A lookup with a different version is a miss, so a
+    ticket that changed since it was cached is fetched again.
+
+    Attributes:
+        path -- file path of the SQLite database
+        maxAgeDays -- entries stored longer ago than this are evicted
+        maxBytes -- once the payloads add up to more than this, least recently used entries are evicted
+        evictEvery -- puts between evictions, so a cache kept open (e.g. by watch mode) stays within its limits
+    """
+    def __init__(self, path, maxAgeDays=30, maxBytes=500 * 1024 * 1024, evictEvery=1000):
+        self.path = path
+        self.maxAgeDays = maxAgeDays
+        self.maxBytes = maxBytes
+        self.evictEvery = evictEvery
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS payloads (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                version TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS payloads_used_at ON payloads (used_at)")
+        self.connection.commit()
+        self.evict()
+
+    # return the cached payload (parsed JSON) if it was stored for this version, otherwise None
+    def get(self, kind, key, version):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT payload FROM payloads WHERE kind = ? AND key = ? AND version = ?",
+                (kind, key, version)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE payloads SET used_at = ? WHERE kind = ? AND key = ?",
+                                    (time.time(), kind, key))
+            self.connection.commit()
+        return json.loads(row[0])
+
+    # store (or replace) the payload for a key at the given version
+    def put(self, kind, key, version, payload):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO payloads (kind, key, version, payload, stored_at, used_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, version, json.dumps(payload), now, now))
+            self.connection.commit()
+            self.puts += 1
+            evict_now = self.puts % self.evictEvery == 0
+        if evict_now:
+            self.evict()
+        return
+
+    # drop entries past the max age, then least recently used entries until the cache fits in maxBytes
+    def evict(self):
+        with self.lock:
+            cutoff = time.time() - self.maxAgeDays * 86400
+            self.connection.execute("DELETE FROM payloads WHERE stored_at < ?", (cutoff,))
+            total = self.connection.execute("SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM payloads").fetchone()[0]
+            if total > self.maxBytes:
+                expired = []
+                for kind, key, size in self.connection.execute(
+                        "SELECT kind, key, LENGTH(payload) FROM payloads ORDER BY used_at"):
+                    if total <= self.maxBytes:
+                        break
+                    expired.append((kind, key))
+                    total -= size
+                self.connection.executemany("DELETE FROM payloads WHERE kind = ? AND key = ?", expired)
+            self.connection.commit()
+        return
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.connection.close()
+        return
@@ -0,0 +1,86 @@
+# Batch comparison engine for the validator. A page (or window) of ticket/response pairs is loaded into columns and
+# every configured ticketFields pair is compared at once, reporting every mismatching field rather than the first
+import numpy as np
+import pandas as pd
+
+# how each ticket field is normalized before comparing, keyed by ticketRecordField. Anything not listed is compared
+# as a string (the original behaviour). A ticketFields entry in a config file can override this with "normalize"
+FIELD_NORMALIZATION = {
+    "status": "status",
+    "createdAt": "date",
+    "closedAt": "date",
+    "updatedAt": "date"
+}
+# ticket status codes and the label the survey's embedded field holds for them
+STATUS_CODES = {
+    "2": "Closed"
+}
+
+# every value as a string, matching str() on the raw value (so None -> "None"). Converted by numpy in one pass,
+# the normalizers all return numpy arrays so the comparison itself is one vectorized !=
+def normalize_string(column):
+    return column.to_numpy(dtype=object).astype(str)
+
+# ticket status codes translated to their labels, other values as strings. Used on both sides, so a survey field
+# holding the raw code still matches
+def normalize_status(column):
+    text = normalize_string(column)
+    for code, label in STATUS_CODES.items():
+        text = np.where(text == code, label, text)
+    return text
+
+# dates parsed (any ISO 8601 form, each value on its own) to UTC nanoseconds, so "2021-08-20T17:03:22Z" matches
+# "2021-08-20T17:03:22.000Z" even within one column. Values that aren't dates are compared as strings
+def normalize_date(column):
+    dates = pd.to_datetime(column, utc=True, errors='coerce', format='ISO8601')
+    nanoseconds = dates.dt.tz_convert(None).to_numpy().astype('datetime64[ns]').astype('int64').astype(str)
+    return np.where(dates.isna().to_numpy(), normalize_string(column), nanoseconds)
+
+# numbers parsed so "5", 5 and "5.0" match. Values that aren't numbers are compared as strings
+def normalize_number(column):
+    numbers = pd.to_numeric(column, errors='coerce')
+    return np.where(numbers.isna().to_numpy(), normalize_string(column), numbers.to_numpy(dtype=float).astype(str))
+
+# normalizers by name: (ticket side, survey side)
+NORMALIZERS = {
+    "string": (normalize_string, normalize_string),
+    "status": (normalize_status, normalize_status),
+    "date": (normalize_date, normalize_date),
+    "number": (normalize_number, normalize_number)
+}
+
+# normalization name for a ticketFields entry from the config file
+def field_normalization(dict_val):
+    return dict_val.get('normalize', FIELD_NORMALIZATION.get(dict_val['ticketRecordField'], "string"))
+
+# compare every field of every pair. Each pair is a dict with the survey, responseId, ticketKey, ticket (the
+# ticket's result object) and values (the response's values). Returns one review file row per mismatching field,
+# ordered by pair and then by field as listed in the config
+def compare_pairs(fields, pairs):
+    if len(pairs) == 0:
+        return []
+    mismatch_positions = []
+    for field_number, dict_val in enumerate(fields):
+        ticket_normalizer, survey_normalizer = NORMALIZERS[field_normalization(dict_val)]
+        ticket_values = [pair['ticket'].get(dict_val['ticketRecordField']) for pair in pairs]
+        survey_values = [pair['values'].get(dict_val['primarySurveyEmbeddedField']) for pair in pairs]
+        mismatched = (ticket_normalizer(pd.Series(ticket_values, dtype=object)) !=
+                      survey_normalizer(pd.Series(survey_values, dtype=object)))
+        for pair_number in mismatched.nonzero()[0]:
+            mismatch_positions.append((int(pair_number), field_number, ticket_values[pair_number],
+                                       survey_values[pair_number]))
+
+    mismatches = []
+    for pair_number, field_number, ticket_value, survey_value in sorted(mismatch_positions, key=lambda m: m[:2]):
+        pair = pairs[pair_number]
+        dict_val = fields[field_number]
+        mismatches.append({
+            "survey": pair['survey'],
+            "responseId": pair['responseId'],
+            "ticketKey": pair['ticketKey'],
+            "ticketField": dict_val['ticketRecordField'],
+            "surveyField": dict_val['primarySurveyEmbeddedField'],
+            "ticketValue": ticket_value,
+            "surveyValue": survey_value
+        })
+    return mismatches
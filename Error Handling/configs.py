@@ -0,0 +1,53 @@
+# In-memory copy of the validator's config files for watch mode, so each file is only read and validated again
+# when it changes on disk (a stat per file per scan instead of a parse)
+import os
+import threading
+
+class ConfigCache:
+    """ parsed config files keyed by path, reparsed when a file's modified time or size changes. Safe to share
+    between threads
+
+    Attributes:
+        loader -- function that reads one config file and returns its parsed data (None if it's invalid)
+        entries -- path -> ((modified time ns, size), parsed data) for every file seen in the last scan
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # bring the cache in line with the given config files. Returns the files that were (re)parsed in this scan,
+    # files no longer in the list are dropped
+    def refresh(self, paths):
+        changed = []
+        with self.lock:
+            for path in list(self.entries):
+                if path not in paths:
+                    del self.entries[path]
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            version = (stat.st_mtime_ns, stat.st_size)
+            with self.lock:
+                entry = self.entries.get(path)
+            if entry is not None and entry[0] == version:
+                continue
+            data = self.loader(path)
+            with self.lock:
+                self.entries[path] = (version, data)
+            changed.append(path)
+        return changed
+
+    # parsed data of a config file (None if it's invalid or wasn't seen in the last scan)
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path)
+        return None if entry is None else entry[1]
+
+    # forget a file, e.g. after writing to it, so the next scan reparses it whatever its modified time
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+        return
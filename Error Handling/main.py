@@ -1,9 +1,62 @@
 import requests
 import jsonschema
-import pandas as pd
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
 import json
 from datetime import datetime, timedelta
 import os
+import io
+import sys
+import time
+import zipfile
+# shared helpers (pooled HTTP sessions) live in the Shared directory next to both tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Shared"))
+import sessions
+import metrics
+import ratelimit
+import cache
+import report
+import archive
+import comparison
+import configs
+
+# default number of ticket/response lookups kept in flight per survey, overridden by "maxWorkers" in the config file
+DEFAULT_MAX_WORKERS = 1
+# number of config files/surveys processed at the same time, and the most that may run against one data center
+CONFIG_WORKERS = 1
+DC_CONCURRENCY = 4
+# directory the config files are read from
+CONFIG_FILES_PATH = '/ErrorHandling/ConfigFiles'
+# on-disk payload cache shared by every config (set to None to turn caching off for the whole run)
+CACHE_PATH = '/ErrorHandling/cache.sqlite'
+# local response archive written by the copy tool (Shared/archive.py, needs pyarrow), None to always call the API.
+# Responses found in it are compared without a GET Response call
+ARCHIVE_PATH = None
+# review file written as mismatches are found: "csv" or "ndjson", optionally gzip compressed
+REPORT_PATH = '/ErrorHandling/ReviewFiles'
+REPORT_FORMAT = 'csv'
+REPORT_GZIP = False
+# directory the run's metrics (JSON summary and Prometheus textfile) are written to
+METRICS_PATH = '/ErrorHandling/Metrics'
+# directory for per-survey checkpoints, so a run that dies part way through resumes where it stopped
+CHECKPOINT_PATH = '/ErrorHandling/Checkpoints'
+# tickets per page returned by the Search Tickets API, also used to batch the merged time-sliced search
+SEARCH_PAGE_SIZE = 50
+# seconds to wait between progress checks on a bulk response export
+EXPORT_POLL_SECONDS = 5
+# days before lastRunDate the bulk export starts from (overridden by "exportLookbackDays" in the config file). Tickets
+# closed in the window mostly belong to responses recorded well before it
+EXPORT_LOOKBACK_DAYS = 30
+# run as a long-running watcher (watch()) instead of one pass over every config file
+WATCH_MODE = False
+# in watch mode, default seconds between ticket searches for a survey (overridden by "watchPollSeconds" in the config
+# file) and seconds between scans of the config directory for new or changed files
+WATCH_POLL_SECONDS = 60
+WATCH_SCAN_SECONDS = 5
+# runs a ticket that couldn't be compared (e.g. its response can't be fetched) is tried in before it's given up on.
+# Until then it's kept in the config file's "retryTickets", and only those tickets are looked up again
+MAX_TICKET_ATTEMPTS = 5
 
 # creating a class object to define each specific survey and persist data through various functions
 class SurveyObject:
@@ -16,15 +69,43 @@ class SurveyObject:
         lastRun -- last run date of the automation
         token -- api token for the user account that contains the survey
         dc -- data center the brand that contains the surveys is on
+        maxWorkers -- number of ticket/response lookups to keep in flight at once
+        bulkExport -- if True, pull the survey's responses in one export instead of one GET per ticket
+        searchSlices -- number of closedAt time slices to search in parallel (1 follows the search pagination)
+        exportLookbackDays -- days before lastRun that the bulk export's responses start from
+        responseIndex -- responseId -> embedded field values, built from the bulk export (None when not used)
+        archiveIndex -- responseId -> embedded field values from the local response archive (None when not used)
+        processedKeys -- ticket keys already compared in this run window (restored from a checkpoint on resume)
+        maxClosedAt -- latest closedAt of the tickets listed so far, written back as the next lastRunDate
+        retryTickets -- ticket key -> {"key", "closedAt", "updatedAt", "attempts"} for the tickets earlier runs
+                        couldn't compare, from the config file
+        failedTickets -- the tickets this run couldn't compare (same form), written back as the next retryTickets
+        cache -- PayloadCache checked before calling the ticket/response APIs (None to always call the API)
+        archive -- ResponseArchive the archiveIndex is read from (None when not used)
+        report -- MismatchWriter that each mismatch row is appended to as soon as it is found
         errors -- list of responses that have incomplete data
     """
-    def __init__(self, tktFields, surveyId, querySearch, lastRun, apiToken, dc):
+    def __init__(self, tktFields, surveyId, querySearch, lastRun, apiToken, dc, maxWorkers=DEFAULT_MAX_WORKERS,
+                 bulkExport=False, searchSlices=1, exportLookbackDays=EXPORT_LOOKBACK_DAYS, retryTickets=None):
         self.fields = tktFields
         self.survey = surveyId
         self.query = querySearch
         self.lastRun = lastRun
         self.token = apiToken
         self.dc = dc
+        self.maxWorkers = maxWorkers
+        self.bulkExport = bulkExport
+        self.searchSlices = searchSlices
+        self.exportLookbackDays = exportLookbackDays
+        self.responseIndex = None
+        self.archiveIndex = None
+        self.processedKeys = set()
+        self.maxClosedAt = None
+        self.retryTickets = {ticket['key']: ticket for ticket in retryTickets or []}
+        self.failedTickets = {}
+        self.cache = None
+        self.archive = None
+        self.report = None
         self.errors = []
     # add any mismatching responses that need to be reviewed to a list
     def append_errors(self, responseId):
@@ -55,23 +136,30 @@ class ApiResponseError(Exception):
     def __str__(self):
         return '{code}, {message}'.format(code=self.error_code,message=self.message)
 
-# transform string to ISO date format object w/ Zulu offset (what the API ingests)
+# transform string to ISO date format object w/ Zulu offset (what the API ingests). The API writes dates both with
+# and without milliseconds
 def iso_format_object(date_string):
-    datetime_obj = datetime.strptime(date_string,'%Y-%m-%dT%H:%M:%S.%fZ')
+    try:
+        datetime_obj = datetime.strptime(date_string,'%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        datetime_obj = datetime.strptime(date_string,'%Y-%m-%dT%H:%M:%SZ')
     return datetime_obj
 
 # transform ISO date object into string w/ Zulu offset
 def iso_format_string(date_obj):
-    strDate = date_obj.isoformat() + ".000Z"
+    strDate = date_obj.isoformat(timespec='milliseconds') + "Z"
     return strDate
 
-# add 1 week to last run date to update config file with after job runs
-def add_one_week(date_obj):
-    new_date = date_obj + timedelta(days=7)
-    return new_date
+# return whichever of two ISO date strings is later (either may be None)
+def later_date(date_a, date_b):
+    if date_a is None:
+        return date_b
+    if date_b is None:
+        return date_a
+    return date_a if iso_format_object(date_a) >= iso_format_object(date_b) else date_b
 
-# function to get config parameters from file (returned as JSON object)
-def list_config_info(file):
+# function to read and validate a config file once (returned as JSON object), None if it's ill-formatted
+def read_config_file(file):
     schema = {
         "type": "object",
         "required": ["ticketFields", "config"]
@@ -81,28 +169,43 @@ def list_config_info(file):
         try:
             data = json.load(json_file)
             jsonschema.validate(data, schema)
-            return data['config']
+            return data
         except jsonschema.exceptions.ValidationError:
             return
         except json.decoder.JSONDecodeError:
             return
 
+# function to get config parameters from file (returned as JSON object)
+def list_config_info(file):
+    data = read_config_file(file)
+    return None if data is None else data['config']
+
 # function to get the ticket/survey data fields to compare (returned as JSON object)
 def list_ticket_fields(file):
-    schema = {
-        "type": "object",
-        "required": ["ticketFields", "config"]
-    }
-    # read in JSON file and extract data needed. Throw errors if ill-fortmated
-    with open(file) as json_file:
-        try:
-            data = json.load(json_file)
-            jsonschema.validate(data, schema)
-            return data['ticketFields']
-        except jsonschema.exceptions.ValidationError:
-            return
-        except json.decoder.JSONDecodeError:
-            return
+    data = read_config_file(file)
+    return None if data is None else data['ticketFields']
+
+# function to apply a parsed config file's optional per-brand API rate limit, shared by every config using the same
+# data center and token. Only called when the file is (re)read, so a poll doesn't reset the brand's limiter
+def apply_rate_limit(data):
+    config = data['config']
+    requests_per_second = config.get('requestsPerSecond')
+    if requests_per_second is not None:
+        ratelimit.set_limit(config['dataCenter'], requests_per_second, config.get('burst'), config['apiToken'])
+    return
+
+# function to create the SurveyObject for a parsed config file, None if it's missing its survey ID
+def create_survey_object(data):
+    tkt_fields = data['ticketFields']
+    config = data['config']
+    survey_id = config.get('surveyId')
+    if tkt_fields is None or survey_id is None:
+        return None
+    # Public API is limited to searching by queries rather than identifying what survey a ticket came from
+    return SurveyObject(tkt_fields, survey_id, config['ticketQuerySearch'], config['lastRunDate'], config['apiToken'],
+                        config['dataCenter'], config.get('maxWorkers', DEFAULT_MAX_WORKERS),
+                        config.get('bulkExport', False), config.get('searchSlices', 1),
+                        config.get('exportLookbackDays', EXPORT_LOOKBACK_DAYS), config.get('retryTickets'))
 
 # function to raise an exception if API doesn't return a 200
 def check_request(request_object):
@@ -113,33 +216,101 @@ def check_request(request_object):
         raise ApiResponseError(http_status, error_message)
     return
 
-# for configs where data is incomplete, create an output file for each run
-def create_csv(run_dict):
-    # create a data frame, and then create a csv based on that data frame for the current run
-    data_frame = pd.DataFrame.from_dict(run_dict, orient='index')
+# for configs where data is incomplete, open the output file for each run that mismatches are streamed into
+def create_report_writer():
     current_date = datetime.today().strftime('%Y_%m_%d')
-    file_path = "/ErrorHandling/ReviewFiles/{file}.csv".format(file="run_"+current_date)
-    data_frame.transpose().to_csv(file_path, index=False)
-    return
+    file_path = os.path.join(REPORT_PATH, "run_{date}.{ext}".format(date=current_date, ext=REPORT_FORMAT))
+    return report.MismatchWriter(file_path, REPORT_FORMAT, REPORT_GZIP)
 
-# write lastRunDate back to config files
-def write_config_params(file, nextRunDate):
+# write lastRunDate (and the tickets to try again next run, if any) back to config files
+def write_config_params(file, nextRunDate, retryTickets=None):
     with open(file, 'r') as json_file:
         data = json.load(json_file)
     data['config']['lastRunDate'] = nextRunDate
+    if retryTickets:
+        data['config']['retryTickets'] = sorted(retryTickets, key=lambda tkt: (tkt.get('closedAt') or "", tkt['key']))
+    else:
+        data['config'].pop('retryTickets', None)
     with open(file, 'w') as json_file:
         json.dump(data, json_file, indent=4)
     return
 
-# function to compare response and ticket data
-def data_comparison(survey_object, tkt_key, headers, dc):
+# GET an API object, reading it from the survey's payload cache when it was stored for the same version (the
+# ticket's last-modified timestamp). Only successful payloads are cached. use_cache=False always calls the API (the
+# payload is still cached)
+def get_api_object(survey_object, kind, key, version, url, headers, dc, use_cache=True):
+    payload_cache = survey_object.cache
+    if payload_cache is not None and version is not None and use_cache:
+        data_object = payload_cache.get(kind, key, version)
+        if data_object is not None:
+            return data_object
+    request = sessions.get_session(dc).get(url, headers=headers)
+    data_object = json.loads(request.text)
+    check_request(data_object)
+    if payload_cache is not None and version is not None:
+        payload_cache.put(kind, key, version, data_object)
+    return data_object
+
+# checkpoint file for a survey
+def checkpoint_path(survey_object):
+    return os.path.join(CHECKPOINT_PATH, "{survey}.json".format(survey=survey_object.survey))
+
+# restore progress from a checkpoint left by an earlier run over the same window. Returns the search cursor
+# (next page URL) to resume from, or None to start from the first page
+def load_checkpoint(survey_object):
+    try:
+        with open(checkpoint_path(survey_object)) as json_file:
+            data = json.load(json_file)
+    except (OSError, json.decoder.JSONDecodeError):
+        return None
+    # a checkpoint for a different window (config already moved on) is stale
+    if data.get('lastRun') != survey_object.lastRun:
+        return None
+    survey_object.processedKeys = set(data['processedKeys'])
+    survey_object.maxClosedAt = data['maxClosedAt']
+    survey_object.failedTickets = {ticket['key']: ticket for ticket in data.get('failedTickets', [])}
+    for response_id in data['errors']:
+        survey_object.append_errors(response_id)
+    print("Resuming {survey} after {count} tickets".format(survey=survey_object.survey,
+                                                          count=len(survey_object.processedKeys)))
+    return data['nextUrl']
+
+# write the survey's progress after a page is finished. Written to a temp file and renamed so a crash mid-write
+# never leaves a corrupt checkpoint
+def save_checkpoint(survey_object, next_url):
+    data = {
+        "lastRun": survey_object.lastRun,
+        "nextUrl": next_url,
+        "processedKeys": sorted(survey_object.processedKeys),
+        "maxClosedAt": survey_object.maxClosedAt,
+        "failedTickets": list(survey_object.failedTickets.values()),
+        "errors": survey_object.return_errors()
+    }
+    os.makedirs(CHECKPOINT_PATH, exist_ok=True)
+    path = checkpoint_path(survey_object)
+    with open(path + ".tmp", 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(path + ".tmp", path)
+    return
+
+# remove a survey's checkpoint once its config file has been updated
+def clear_checkpoint(survey_object):
+    try:
+        os.remove(checkpoint_path(survey_object))
+    except FileNotFoundError:
+        pass
+    return
+
+# function to pull the ticket and its response's data so they can be compared, returns None if either isn't available.
+# use_archive=False skips the local archive and use_cache=False the payload cache, to check stored values against the
+# API
+def fetch_ticket_pair(survey_object, tkt_key, headers, dc, tkt_version=None, use_archive=True, use_cache=True):
     # pull the ticket data for the given key
     tkt_url = "https://{dc}.qualtrics.com/API/v3/tickets/{key}".format(dc=dc, key=tkt_key)
-    tkt_request = requests.get(tkt_url, headers=headers)
-    tkt_data_object = json.loads(tkt_request.text)                                     # object containing ticket data
     # check request status for ticket API. If errors out, move onto the next ticket
     try:
-        check_request(tkt_data_object)
+        tkt_data_object = get_api_object(survey_object, "ticket", tkt_key, tkt_version, tkt_url, headers, dc,
+                                         use_cache)
     except ApiResponseError as e:
         print("GET Ticket error: " + str(e))
         return
@@ -148,98 +319,353 @@ def data_comparison(survey_object, tkt_key, headers, dc):
     response_id = tkt_data_object['result']['responseId']
     survey_id = tkt_data_object['result']['sourceId']
 
-    # pull the response data for the associated responses
-    response_url = "https://{dc}.qualtrics.com/API/v3/surveys/{sid}/responses/{rid}".format(dc=dc, sid=survey_id, rid=response_id)
-    response_request = requests.get(response_url, headers=headers)
-    response_data_object = json.loads(response_request.text)                           # object containing response data
-    # check request status for ticket API. If errors out, move onto the next ticket
-    try:
-        check_request(response_data_object)
-    except ApiResponseError as e:
-        print("GET Response error: " + str(e))
-        return
+    # use the bulk export index when the response is in it, then the local archive, otherwise (no index, response
+    # recorded before the export window, or a ticket from another survey) fall back to pulling the single response
+    response_index = survey_object.responseIndex
+    archive_index = survey_object.archiveIndex if use_archive else None
+    from_archive = False
+    if response_index is not None and survey_id == survey_object.survey and response_id in response_index:
+        response_values = response_index[response_id]
+    elif archive_index is not None and survey_id == survey_object.survey and response_id in archive_index:
+        response_values = archive_index[response_id]
+        from_archive = True
+    else:
+        # pull the response data for the associated responses
+        response_url = "https://{dc}.qualtrics.com/API/v3/surveys/{sid}/responses/{rid}".format(dc=dc, sid=survey_id, rid=response_id)
+        # check request status for response API. If errors out, move onto the next ticket
+        try:
+            response_data_object = get_api_object(survey_object, "response", response_id, tkt_version,
+                                                  response_url, headers, dc, use_cache)
+        except ApiResponseError as e:
+            print("GET Response error: " + str(e))
+            return
+        response_values = response_data_object['result']['values']
 
-    # for the ticket, we have gotten the survey and ticket data. Now, need to check that the fields (specified by the
-    # config files) match between the 2 data sources
-    list_of_fields = survey_object.fields
-    for dict_val in list_of_fields:
-        tkt_field = tkt_data_object['result'][dict_val['ticketRecordField']]
-        survey_field = response_data_object['result']['values'][dict_val['primarySurveyEmbeddedField']]
-        if dict_val['ticketRecordField'] == "status":
-            if tkt_field == 2 and survey_field == "Closed":
-                continue
-        if str(tkt_field) != str(survey_field):
-            return response_id
-    return
+    # the fields (specified by the config files) are compared for the whole page at once by the comparison engine
+    pair = {
+        "survey": survey_object.survey,
+        "responseId": response_id,
+        "ticketKey": tkt_key,
+        "ticket": tkt_data_object['result'],
+        "values": response_values,
+        "fromArchive": from_archive
+    }
+    return pair
 
-# function to list the closed ticket for each program
-def find_mismatched_responses(survey_object):
-    # set parameters
-    dc = survey_object.dc
-    token = survey_object.token
-    last_run = survey_object.lastRun
-    query = survey_object.query
-    # set header for API request
-    headers = {
-        "X-API-TOKEN": token,
-        "Content-Type": "application/json"
+# the earliest RecordedDate of the responses looked up locally: exportLookbackDays before the last run
+def response_window_start(survey_object):
+    return iso_format_string(iso_format_object(survey_object.lastRun) - timedelta(days=survey_object.exportLookbackDays))
+
+# export every response recorded since the lookback before the last run in one job (same start/poll/download flow as
+# responses.get_export_file in the copy tool) and index the values by responseId for local lookups
+def export_response_index(survey_object, headers, dc):
+    survey_id = survey_object.survey
+    export_url = "https://{dc}.qualtrics.com/API/v3/surveys/{sid}/export-responses".format(dc=dc, sid=survey_id)
+    data = {
+        "format": "json",
+        "startDate": response_window_start(survey_object),
+        "embeddedDataIds": [dict_val['primarySurveyEmbeddedField'] for dict_val in survey_object.fields]
     }
-    # API request URL
-    request_url = "https://{dc}.qualtrics.com/API/v3/tickets/search".format(dc=dc)
-    # set the body for the Search Tickets request
+    request_text = json.loads(sessions.get_session(dc).post(export_url, data=json.dumps(data), headers=headers).text)
+    check_request(request_text)
+    progress_id = request_text['result']['progressId']
+
+    # keep polling for progress until the export is complete
+    status = ""
+    poll_start = time.monotonic()
+    while status != "complete":
+        progress_url = export_url + "/" + progress_id
+        request_text = json.loads(sessions.get_session(dc).get(progress_url, headers=headers).text)
+        check_request(request_text)
+        status = request_text['result']['status']
+        if status == "failed":
+            raise ApiResponseError(request_text['meta']['httpStatus'], "Response export failed for " + survey_id)
+        if status != "complete":
+            print("Sleeping - {survey} export {pct}%".format(survey=survey_id,
+                                                             pct=request_text['result'].get('percentComplete')))
+            time.sleep(EXPORT_POLL_SECONDS)
+    metrics.record_poll("export_response_index", time.monotonic() - poll_start)
+    file_id = request_text['result']['fileId']
+
+    # download the zipped JSON file and build the responseId -> values index
+    file_url = export_url + "/" + file_id + "/file"
+    download = sessions.get_session(dc).get(file_url, headers=headers)
+    response_index = {}
+    with zipfile.ZipFile(io.BytesIO(download.content)) as zip_file:
+        for name in zip_file.namelist():
+            for response in json.loads(zip_file.read(name))['responses']:
+                response_index[response['responseId']] = response['values']
+    return response_index
+
+# wrapper so one ticket failing (network error, bad JSON, missing field) is reported without stopping the other
+# lookups that are in flight for the same page
+def safe_fetch_ticket_pair(survey_object, tkt_key, headers, dc, tkt_version=None, use_archive=True, use_cache=True):
+    try:
+        return fetch_ticket_pair(survey_object, tkt_key, headers, dc, tkt_version, use_archive, use_cache)
+    except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+        print("Ticket {key} error: {err}".format(key=tkt_key, err=repr(e)))
+        return
+
+# build the Search Tickets body for the survey's tickets closed after closed_after (and before closed_before)
+def search_body(query, closed_after, closed_before=None):
+    children = [
+        {
+            "queryType": "closedAt",
+            "comparison": "gt",
+            "value": closed_after
+        },
+        {
+            "queryType": "name",
+            "comparison": "contains",
+            "value": query
+        }
+    ]
+    if closed_before is not None:
+        children.append({
+            "queryType": "closedAt",
+            "comparison": "lt",
+            "value": closed_before
+        })
     body = {
         "query": {
             "queryType": "compound",
             "comparison": "and",
-            "children": [
-                {
-                    "queryType": "closedAt",
-                    "comparison": "gt",
-                    "value": last_run
-                },
-                {
-                    "queryType": "name",
-                    "comparison": "contains",
-                    "value": query
-                }
-            ]
+            "children": children
         }
     }
-    # make API request, allowing for pagination of response (max 50 per page)
+    return body
+
+# make Search Tickets API requests, following the pagination of the response (max 50 per page), one page at a time.
+# Yields each page with the URL of the page after it (None on the last page), starting from start_url if given
+def search_ticket_pages(headers, dc, body, start_url=None):
+    request_url = start_url or "https://{dc}.qualtrics.com/API/v3/tickets/search".format(dc=dc)
     while request_url is not None:
-        request = requests.post(request_url, data=json.dumps(body), headers=headers)
+        request = sessions.get_session(dc).post(request_url, data=json.dumps(body), headers=headers)
         request_text = json.loads(request.text)
         # check request status for search tickets API success
         check_request(request_text)
 
-        # checking for a non-zero # of tickets
+        # an empty page means there is nothing (left) to list
         if len(request_text['result']['elements']) == 0:
-            print("{survey} has no Closed Tickets since {date}".format(date=last_run, survey=survey_object.survey))
             return
+        request_url = request_text['result']['links']['next']['href']
+        yield request_text['result']['elements'], request_url
+
+# split the closedAt > lastRun window into survey_object.searchSlices time slices and page through each slice's
+# search at the same time. Slices overlap by 1ms at each boundary so nothing is missed; duplicates are dropped
+# by ticket key and the merged list is ordered by closedAt/key so the run is deterministic
+def search_tickets_sliced(survey_object, headers, dc):
+    slices = survey_object.searchSlices
+    window_start = iso_format_object(survey_object.lastRun)
+    step = (datetime.utcnow() - window_start) / slices
+    bounds = [window_start + step * i for i in range(slices)]
+    bodies = []
+    for i, slice_start in enumerate(bounds):
+        slice_end = None
+        if i + 1 < slices:
+            slice_end = iso_format_string(bounds[i + 1] + timedelta(milliseconds=1))
+        bodies.append(search_body(survey_object.query, iso_format_string(slice_start), slice_end))
 
-        ticket_list = request_text['result']['elements']
-        # iterate through each closed ticket return from the query
+    with ThreadPoolExecutor(max_workers=slices) as executor, metrics.stage("search_tickets_sliced"):
+        slice_results = list(executor.map(
+            lambda body: [tkt for page, next_url in search_ticket_pages(headers, dc, body) for tkt in page], bodies))
+
+    tickets = {}
+    for ticket_list in slice_results:
         for tkt in ticket_list:
-            key = tkt['key']
-            response_error = data_comparison(survey_object, key, headers, dc)
-            if response_error is not None:
-                survey_object.append_errors(response_error)
-        request_url = request_text['result']['links']['next']['href']
+            tickets.setdefault(tkt['key'], tkt)
+    return sorted(tickets.values(), key=lambda tkt: (tkt.get('closedAt') or "", tkt['key']))
+
+# yield the survey's closed tickets a page at a time (with the cursor to resume after that page), either straight
+# from the search pagination or, when searchSlices > 1, in SEARCH_PAGE_SIZE chunks of the merged time-sliced search.
+# The sliced search has no cursor, a resumed run lists again and skips the keys it already processed
+def closed_ticket_pages(survey_object, headers, dc, start_url=None):
+    if survey_object.searchSlices <= 1:
+        body = search_body(survey_object.query, survey_object.lastRun)
+        yield from search_ticket_pages(headers, dc, body, start_url)
+        return
+    tickets = search_tickets_sliced(survey_object, headers, dc)
+    for i in range(0, len(tickets), SEARCH_PAGE_SIZE):
+        yield tickets[i:i + SEARCH_PAGE_SIZE], None
+
+# pull and compare a list of tickets, writing each mismatch to the survey's error list and review file as it's found.
+# Returns the keys of the tickets that were actually compared
+def compare_tickets(survey_object, executor, ticket_list, headers, dc):
+    # pull each ticket and its response, keeping up to maxWorkers lookups in flight. executor.map hands results
+    # back in list order, so the error list is the same as a serial run. the ticket's last-modified time versions
+    # its cached payloads
+    with metrics.stage("fetch_ticket_pairs"):
+        results = executor.map(lambda tkt: safe_fetch_ticket_pair(survey_object, tkt['key'], headers, dc,
+                                                                  tkt.get('updatedAt') or tkt.get('closedAt')),
+                               ticket_list)
+        pairs = [pair for pair in results if pair is not None]
+    compared_keys = {pair['ticketKey'] for pair in pairs}
+    # compare every configured field of the whole list at once, reporting each mismatching field. Rows come back
+    # grouped by ticket, so each mismatching ticket adds its responseId to the error list once
+    last_ticket = None
+    with metrics.stage("compare_pairs"):
+        mismatches = comparison.compare_pairs(survey_object.fields, pairs)
+    # an archived response can be older than the live one (e.g. updated after it was exported), so tickets
+    # that mismatch on archived values are fetched from the API and compared again before being reported. The
+    # payload cache is skipped too, it could hold an equally old copy under the same ticket version
+    archived_keys = {pair['ticketKey'] for pair in pairs if pair['fromArchive']}
+    recheck_keys = {mismatch['ticketKey'] for mismatch in mismatches} & archived_keys
+    if len(recheck_keys) > 0:
+        recheck_list = [tkt for tkt in ticket_list if tkt['key'] in recheck_keys]
+        results = executor.map(lambda tkt: safe_fetch_ticket_pair(survey_object, tkt['key'], headers, dc,
+                                                                  tkt.get('updatedAt') or tkt.get('closedAt'),
+                                                                  use_archive=False, use_cache=False),
+                               recheck_list)
+        rechecked = [pair for pair in results if pair is not None]
+        # a ticket whose recheck failed hasn't really been compared
+        compared_keys -= recheck_keys - {pair['ticketKey'] for pair in rechecked}
+        mismatches = ([mismatch for mismatch in mismatches if mismatch['ticketKey'] not in recheck_keys] +
+                      comparison.compare_pairs(survey_object.fields, rechecked))
+    for mismatch in mismatches:
+        if mismatch['ticketKey'] != last_ticket:
+            survey_object.append_errors(mismatch['responseId'])
+            last_ticket = mismatch['ticketKey']
+        if survey_object.report is not None:
+            survey_object.report.write_row(mismatch)
+    return compared_keys
+
+# mark the compared tickets of a list as processed. The rest are kept to try again next run, until they've failed
+# MAX_TICKET_ATTEMPTS runs in a row
+def record_compared(survey_object, ticket_list, compared_keys):
+    for tkt in ticket_list:
+        key = tkt['key']
+        if key in compared_keys:
+            survey_object.processedKeys.add(key)
+            survey_object.failedTickets.pop(key, None)
+            continue
+        attempts = survey_object.retryTickets.get(key, {}).get('attempts', 0) + 1
+        if attempts >= MAX_TICKET_ATTEMPTS:
+            print("Ticket {key} couldn't be compared in {count} runs, giving up on it".format(key=key, count=attempts))
+            survey_object.processedKeys.add(key)
+            survey_object.failedTickets.pop(key, None)
+            continue
+        survey_object.failedTickets[key] = {"key": key, "closedAt": tkt.get('closedAt'),
+                                            "updatedAt": tkt.get('updatedAt'), "attempts": attempts}
+    return
+
+# build the survey's local response lookups: the archive index and, with bulkExport, the bulk export's index. Only
+# called once there are tickets to compare, so a poll that finds none doesn't export or read anything
+def load_response_indexes(survey_object, headers, dc):
+    # responses the copy tool has archived locally are compared without calling the API. Only the lookback window's
+    # date partitions are read, an older response is fetched from the API like one that isn't archived
+    if survey_object.archive is not None:
+        embedded_fields = [dict_val['primarySurveyEmbeddedField'] for dict_val in survey_object.fields]
+        with metrics.stage("archive_index"):
+            survey_object.archiveIndex = survey_object.archive.index(survey_object.survey,
+                                                                     start=response_window_start(survey_object),
+                                                                     columns=embedded_fields)
+    # optionally pull all of the survey's responses in one export so each ticket is compared with a local lookup
+    if survey_object.bulkExport:
+        try:
+            with metrics.stage("export_response_index"):
+                survey_object.responseIndex = export_response_index(survey_object, headers, dc)
+        except (ApiResponseError, requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print("Bulk export error for {survey}, falling back to GET Response: {err}".format(
+                survey=survey_object.survey, err=repr(e)))
+    return
+
+# function to list the closed ticket for each program
+def find_mismatched_responses(survey_object):
+    # set parameters
+    dc = survey_object.dc
+    token = survey_object.token
+    last_run = survey_object.lastRun
+    # set header for API request
+    headers = {
+        "X-API-TOKEN": token,
+        "Content-Type": "application/json"
+    }
+    # pick up from the last finished page if an earlier run over this window died part way through
+    start_url = load_checkpoint(survey_object)
+    found_tickets = len(survey_object.processedKeys) > 0
+    indexes_loaded = False
+    with ThreadPoolExecutor(max_workers=survey_object.maxWorkers) as executor:
+        # tickets earlier runs couldn't compare are looked up again on their own, the window isn't searched again
+        retry_list = [tkt for key, tkt in survey_object.retryTickets.items()
+                      if key not in survey_object.processedKeys and key not in survey_object.failedTickets]
+        if len(retry_list) > 0:
+            found_tickets = True
+            print("{survey}: retrying {count} tickets".format(survey=survey_object.survey, count=len(retry_list)))
+            load_response_indexes(survey_object, headers, dc)
+            indexes_loaded = True
+            record_compared(survey_object, retry_list, compare_tickets(survey_object, executor, retry_list, headers, dc))
+            save_checkpoint(survey_object, start_url)
+        for page, next_url in closed_ticket_pages(survey_object, headers, dc, start_url):
+            found_tickets = True
+            ticket_list = [tkt for tkt in page if tkt['key'] not in survey_object.processedKeys]
+            if len(ticket_list) > 0 and not indexes_loaded:
+                load_response_indexes(survey_object, headers, dc)
+                indexes_loaded = True
+            compared_keys = compare_tickets(survey_object, executor, ticket_list, headers, dc)
+            # the page is done: record its tickets and the latest closedAt seen, then checkpoint
+            for tkt in ticket_list:
+                survey_object.maxClosedAt = later_date(survey_object.maxClosedAt, tkt.get('closedAt'))
+            record_compared(survey_object, ticket_list, compared_keys)
+            save_checkpoint(survey_object, next_url)
+
+    # checking for a non-zero # of tickets
+    if not found_tickets:
+        print("{survey} has no Closed Tickets since {date}".format(date=last_run, survey=survey_object.survey))
+        return
     # get the survey objects list of response ID errors and return
     mismatched_responses = survey_object.return_errors()
     return mismatched_responses
 
-def main():
-    # specify path for where to find config files
-    config_files_path = '/ErrorHandling/ConfigFiles'
+# run the comparison for one config file and, if it finished, write the next run date back to that file (a failed
+# run keeps its checkpoint so the next launch resumes it).
+# dc_limit caps how many configs hit the same data center at once
+def process_config(file, survey_object, dc_limit):
+    with dc_limit:
+        try:
+            with metrics.stage("find_mismatched_responses"):
+                mismatched_responses = find_mismatched_responses(survey_object)
+        except (ApiResponseError, requests.exceptions.RequestException, ValueError, KeyError) as e:
+            # leave lastRunDate alone so the next run covers this window again
+            print("Survey {survey} failed, config not updated: {err}".format(survey=survey_object.survey, err=repr(e)))
+            return
+
+    # the next run starts after the latest ticket listed, if there were none the window stays put. Tickets that
+    # couldn't be compared are saved with it, so the next run looks only those up again
+    next_run_date = later_date(survey_object.lastRun, survey_object.maxClosedAt)
+
+    # update config file with new lastRunTime, then the checkpoint for this window is no longer needed
+    write_config_params(file, next_run_date, list(survey_object.failedTickets.values()))
+    clear_checkpoint(survey_object)
+    return mismatched_responses
+
+# list the config files in CONFIG_FILES_PATH, None if the directory doesn't exist
+def list_config_files():
     config_file_list = []
     # get all files in the specified directory, if it exists
     try:
-        next(os.walk(config_files_path))
-        for root, dirs, files in os.walk(config_files_path):
+        next(os.walk(CONFIG_FILES_PATH))
+        for root, dirs, files in os.walk(CONFIG_FILES_PATH):
             config_file_list = [os.path.join(root, name) for name in files]
     except StopIteration:
-        print("That directory path doesn't exist. Please update in code (line 234).")
+        return None
+    return config_file_list
+
+# open the local response archive at ARCHIVE_PATH, None if it isn't configured or pyarrow isn't installed
+def open_response_archive():
+    if ARCHIVE_PATH is None:
+        return None
+    try:
+        return archive.ResponseArchive(ARCHIVE_PATH)
+    except archive.ArchiveUnavailable as e:
+        print("{err}, comparing against the API instead".format(err=e))
+        return None
+
+def main():
+    run_start = time.monotonic()
+    config_file_list = list_config_files()
+    if config_file_list is None:
+        print("That directory path doesn't exist. Please update CONFIG_FILES_PATH.")
+        return None
 
     # check if no files
     if len(config_file_list) == 0:
@@ -247,46 +673,187 @@ def main():
         return None
 
     # iterate through all config files and create an object for each unique file/survey. Add to list
-    obj_list = {}
+    config_objects = []
+    cache_configs = []
+    archive_configs = []
     for file in config_file_list:
-        # check for if json file is not configured correctly for 2 dictionaries we pull
-        try:
-            tkt_fields = list_ticket_fields(file)
-            if tkt_fields is None:
-                raise TypeError
-        except TypeError:
+        # each file is read once, check for if json file is not configured correctly for 2 dictionaries we pull
+        data = read_config_file(file)
+        obj = None if data is None else create_survey_object(data)
+        if obj is None:
             print("File {file} has invalid JSON, please correct.".format(file=file.split("/")[-1]))
             return
-
-        try:
-            survey_id = list_config_info(file)['surveyId']
-            if survey_id is None:
-                raise TypeError
-        except TypeError:
-            print("File {file} has invalid JSON, please correct.".format(file=file.split("/")[-1]))
-            return
-        # Public API is limited to searching by queries rather than identifying what survey a ticket came from
-        query = list_config_info(file)['ticketQuerySearch']
-        api_token = list_config_info(file)['apiToken']
-        dc = list_config_info(file)['dataCenter']
-        last_run = list_config_info(file)['lastRunDate']
+        apply_rate_limit(data)
 
         # instantiate SurveyObject class for each config file/survey, add to a dictionary
-        obj = SurveyObject(tkt_fields, survey_id, query, last_run, api_token, dc)
-        # now get the list of all relevant tickets for each survey/config
-        obj_list[survey_id] = find_mismatched_responses(obj)
+        config_objects.append((file, obj))
+        if data['config'].get('useCache', True):
+            cache_configs.append(obj)
+        if data['config'].get('useArchive', True):
+            archive_configs.append(obj)
+
+    # mismatches from every survey are streamed into one review file for the run
+    report_writer = create_report_writer()
+    for file, obj in config_objects:
+        obj.report = report_writer
 
-        # add a week to the lastRunDate to write as the new run date
-        last_run_obj = iso_format_object(last_run)
-        next_run_obj = add_one_week(last_run_obj)
-        next_run_date = iso_format_string(next_run_obj)
+    # one cache is shared by every survey that didn't opt out with "useCache": false
+    payload_cache = None
+    if CACHE_PATH is not None and len(cache_configs) > 0:
+        payload_cache = cache.PayloadCache(CACHE_PATH)
+        for obj in cache_configs:
+            obj.cache = payload_cache
+
+    # the local response archive, for every survey that didn't opt out with "useArchive": false
+    if len(archive_configs) > 0:
+        response_archive = open_response_archive()
+        for obj in archive_configs:
+            obj.archive = response_archive
+
+    # now get the list of all relevant tickets for each survey/config, running up to CONFIG_WORKERS configs at once
+    # and at most DC_CONCURRENCY per data center. Each config only writes back to its own file
+    dc_limits = {obj.dc: threading.BoundedSemaphore(DC_CONCURRENCY) for file, obj in config_objects}
+    try:
+        with ThreadPoolExecutor(max_workers=CONFIG_WORKERS) as executor:
+            futures = [(obj.survey, executor.submit(process_config, file, obj, dc_limits[obj.dc]))
+                       for file, obj in config_objects]
+        # summarize in config file order, the rows themselves are already in the review file. A survey that failed
+        # with an error process_config doesn't handle (e.g. writing its checkpoint) doesn't stop the others' summary
+        for survey_id, future in futures:
+            try:
+                mismatched_responses = future.result()
+            except Exception as e:
+                print("Survey {survey} failed, config not updated: {err}".format(survey=survey_id, err=repr(e)))
+                continue
+            if mismatched_responses is not None:
+                print("{survey}: {count} mismatched responses".format(survey=survey_id,
+                                                                      count=len(mismatched_responses)))
+    finally:
+        # whatever happened, keep what was found and the run's metrics
+        report_writer.close()
+        if payload_cache is not None:
+            payload_cache.close()
+        sessions.close_sessions()
+        # per-endpoint/per-stage timings for the run
+        metrics.record_stage("main", time.monotonic() - run_start)
+        os.makedirs(METRICS_PATH, exist_ok=True)
+        metrics.write_summary(METRICS_PATH, "error_handling")
+    return
+
+# long-running alternative to main(): keeps the config files in memory (reparsed only when they change) and checks
+# each survey's newly closed tickets every WATCH_POLL_SECONDS, so mismatches turn up minutes after a ticket closes.
+# The scan loop queues each survey when it's due and CONFIG_WORKERS threads work through the queue, one poll per
+# survey at a time. Runs until stop_event is set (or Ctrl+C)
+def watch(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    config_cache = configs.ConfigCache(read_config_file)
+    work_queue = queue.Queue()
+    state_lock = threading.Lock()
+    # files queued or being polled, and when each file is next due (monotonic seconds)
+    scheduled = set()
+    next_poll = {}
+    dc_limits = {}
+    payload_cache = cache.PayloadCache(CACHE_PATH) if CACHE_PATH is not None else None
+    response_archive = open_response_archive()
+    # the review file is per day, a writer replaced at midnight is closed once no poll can still be using it
+    report_writer = create_report_writer()
+    report_date = datetime.today().date()
+    retired_writers = []
+
+    # poll one survey: a fresh SurveyObject from the cached config, so each poll only covers its own window
+    def poll_config(file, data, writer):
+        obj = create_survey_object(data)
+        obj.report = writer
+        if data['config'].get('useCache', True):
+            obj.cache = payload_cache
+        if data['config'].get('useArchive', True):
+            obj.archive = response_archive
+        with state_lock:
+            dc_limit = dc_limits.setdefault(obj.dc, threading.BoundedSemaphore(DC_CONCURRENCY))
+        mismatched_responses = process_config(file, obj, dc_limit)
+        # the new lastRunDate was just written, make sure the next poll reads it
+        config_cache.invalidate(file)
+        if mismatched_responses:
+            print("{survey}: {count} mismatched responses".format(survey=obj.survey,
+                                                                  count=len(mismatched_responses)))
+        return
+
+    def worker():
+        while True:
+            job = work_queue.get()
+            if job is None:
+                return
+            file, data, writer = job
+            try:
+                poll_config(file, data, writer)
+            except Exception as e:
+                print("Watching {file} failed, retrying next poll: {err}".format(file=file.split("/")[-1], err=repr(e)))
+            finally:
+                with state_lock:
+                    scheduled.discard(file)
+                    next_poll[file] = time.monotonic() + data['config'].get('watchPollSeconds', WATCH_POLL_SECONDS)
+
+    threads = [threading.Thread(target=worker, daemon=True) for i in range(CONFIG_WORKERS)]
+    for thread in threads:
+        thread.start()
+    print("Watching {path} for closed tickets".format(path=CONFIG_FILES_PATH))
+    try:
+        while not stop_event.is_set():
+            config_file_list = list_config_files()
+            if config_file_list is None:
+                print("That directory path doesn't exist. Please update CONFIG_FILES_PATH.")
+                config_file_list = []
+            for file in config_cache.refresh(config_file_list):
+                data = config_cache.get(file)
+                if data is None or data['config'].get('surveyId') is None:
+                    print("File {file} has invalid JSON, please correct.".format(file=file.split("/")[-1]))
+                    continue
+                apply_rate_limit(data)
 
-        # update config file with new lastRunTime
-        write_config_params(file, next_run_date)
+            if datetime.today().date() != report_date:
+                retired_writers.append(report_writer)
+                report_writer = create_report_writer()
+                report_date = datetime.today().date()
+            now = time.monotonic()
+            with state_lock:
+                if len(scheduled) == 0:
+                    for writer in retired_writers:
+                        writer.close()
+                    retired_writers = []
+                for file in config_file_list:
+                    data = config_cache.get(file)
+                    if data is None or data['config'].get('surveyId') is None:
+                        continue
+                    if file in scheduled or next_poll.get(file, 0) > now:
+                        continue
+                    scheduled.add(file)
+                    work_queue.put((file, data, report_writer))
+            # keep the metrics files current for whatever is scraping them
+            os.makedirs(METRICS_PATH, exist_ok=True)
+            metrics.write_summary(METRICS_PATH, "error_handling")
+            stop_event.wait(WATCH_SCAN_SECONDS)
+    except KeyboardInterrupt:
+        print("Stopping after the polls in progress")
+    # let the polls in progress finish, queued ones are skipped
+    with state_lock:
+        while not work_queue.empty():
+            work_queue.get_nowait()
+    for thread in threads:
+        work_queue.put(None)
+    for thread in threads:
+        thread.join()
 
-    # call function to create output csv file of incorrect data pairs
-    create_csv(obj_list)
+    for writer in retired_writers + [report_writer]:
+        writer.close()
+    if payload_cache is not None:
+        payload_cache.close()
+    sessions.close_sessions()
+    os.makedirs(METRICS_PATH, exist_ok=True)
+    metrics.write_summary(METRICS_PATH, "error_handling")
     return
 
 if __name__ == '__main__':
-    main()
+    if WATCH_MODE:
+        watch()
+    else:
+        main()
@@ -0,0 +1,51 @@
+# Incremental writer for the validator's review file. Each mismatch is appended (and flushed) as soon as it is
+# found, so memory stays flat and a crashed run still leaves everything found so far on disk
+import csv
+import gzip
+import json
+import os
+import threading
+
+# columns of every mismatch row, in output order
+REPORT_COLUMNS = ["survey", "responseId", "ticketKey", "ticketField", "surveyField", "ticketValue", "surveyValue"]
+
+class MismatchWriter:
+    """ appends mismatch rows to a CSV or NDJSON file, optionally gzip compressed. Safe to share between threads
+
+    Attributes:
+        path -- file path of the review file (".gz" is added when compressed)
+        fileFormat -- "csv" or "ndjson"
+        compress -- if True, write through gzip (appending to an existing file adds a new gzip member)
+    """
+    def __init__(self, path, fileFormat="csv", compress=False):
+        if fileFormat not in ("csv", "ndjson"):
+            raise ValueError("Unknown report format: " + fileFormat)
+        self.path = path + ".gz" if compress else path
+        self.fileFormat = fileFormat
+        self.compress = compress
+        self.lock = threading.Lock()
+        # only a new (or empty) csv file needs the header row, a rerun on the same day keeps appending
+        write_header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if compress:
+            self.file = gzip.open(self.path, "at", newline="")
+        else:
+            self.file = open(self.path, "a", newline="")
+        self.csvWriter = csv.DictWriter(self.file, fieldnames=REPORT_COLUMNS)
+        if fileFormat == "csv" and write_header:
+            self.csvWriter.writeheader()
+            self.file.flush()
+
+    # append one mismatch row (a dict with the REPORT_COLUMNS keys) and flush it to disk
+    def write_row(self, row):
+        with self.lock:
+            if self.fileFormat == "csv":
+                self.csvWriter.writerow(row)
+            else:
+                self.file.write(json.dumps(row, default=str) + "\n")
+            self.file.flush()
+        return
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        return
@@ -0,0 +1,150 @@
+# Local columnar archive of exported survey responses, shared by both tools. The copy tool adds each export it
+# downloads; the validator (and copy verification) look responses up here instead of calling the API again.
+# Stored as zstd compressed Parquet, partitioned by survey and by the UTC date each response was recorded, so a
+# lookup only reads the survey's files (and only the dates asked for). Needs pyarrow, which is optional: nothing
+# else in either tool imports it
+import os
+import uuid
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# rows held in memory before they are written out as Parquet files
+BATCH_ROWS = 10000
+COMPRESSION = "zstd"
+# columns every archived response has, the rest are the export's own columns
+RESPONSE_ID_COLUMN = "ResponseId"
+RECORDED_COLUMN = "RecordedDate"
+
+class ArchiveUnavailable(Exception):
+    """ Exception raised when the archive is used without pyarrow installed
+
+    Attributes:
+        path -- root directory of the archive that was asked for
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return 'pyarrow is needed for the response archive at {path}'.format(path=self.path)
+
+class ResponseArchive:
+    """ Parquet response archive under one root directory, laid out as survey=<id>/date=<YYYY-MM-DD>/*.parquet
+
+    Every column is stored as a string, as exported. RecordedDate is stored as an ISO 8601 UTC string. A response
+    exported more than once (e.g. a full re-export) is archived more than once, queries return the copy archived
+    last.
+
+    Attributes:
+        path -- root directory of the archive
+    """
+    def __init__(self, path):
+        if pyarrow is None:
+            raise ArchiveUnavailable(path)
+        self.path = path
+
+    def survey_path(self, survey_id):
+        return os.path.join(self.path, "survey={survey}".format(survey=survey_id))
+
+    # add responses to a survey's archive. rows is any iterable of lists in the order of columns (streamed, so an
+    # export of any size is written BATCH_ROWS at a time), which must include ResponseId and RecordedDate (already
+    # converted to ISO 8601 UTC). Returns the number of rows archived
+    def append(self, survey_id, columns, rows):
+        if RESPONSE_ID_COLUMN not in columns or RECORDED_COLUMN not in columns:
+            raise ValueError("Archived responses need {id} and {recorded} columns".format(id=RESPONSE_ID_COLUMN,
+                                                                                      recorded=RECORDED_COLUMN))
+        recorded = columns.index(RECORDED_COLUMN)
+        batches = {}
+        count = 0
+        for row in rows:
+            batches.setdefault(row[recorded][:10], []).append(row)
+            count += 1
+            if count % BATCH_ROWS == 0:
+                self.write_batches(survey_id, columns, batches)
+                batches = {}
+        self.write_batches(survey_id, columns, batches)
+        return count
+
+    # write one Parquet file per recorded date, under a unique name so concurrent writers never collide
+    def write_batches(self, survey_id, columns, batches):
+        for date, rows in batches.items():
+            directory = os.path.join(self.survey_path(survey_id), "date={date}".format(date=date))
+            os.makedirs(directory, exist_ok=True)
+            table = pyarrow.table({name: pyarrow.array([row[i] for row in rows], pyarrow.string())
+                                   for i, name in enumerate(columns)})
+            path = os.path.join(directory, "part-{id}.parquet".format(id=uuid.uuid4().hex))
+            # written under a temporary name first, so a reader never sees a half written file
+            pyarrow.parquet.write_table(table, path + ".tmp", compression=COMPRESSION)
+            os.replace(path + ".tmp", path)
+        return
+
+    # get a survey's archived responses as a list of {"responseId", "recordedDate", "values"} dicts. Filters are
+    # optional: response_ids (any iterable), start/end (ISO 8601 UTC, start inclusive, end exclusive) and columns
+    # (the value columns to return, all of them if None)
+    def query(self, survey_id, response_ids=None, start=None, end=None, columns=None):
+        survey_path = self.survey_path(survey_id)
+        if not os.path.isdir(survey_path):
+            return []
+        files = [os.path.join(root, name) for root, dirs, names in os.walk(survey_path)
+                 for name in names if name.endswith(".parquet")]
+        # skip whole date partitions outside the range without opening them
+        files = [path for path in files if in_date_range(partition_date(path), start, end)]
+        if len(files) == 0:
+            return []
+        # newest file first, so the first copy of a response read is the one archived last
+        files.sort(key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+        # exports can have different columns (e.g. a question added later), so read with every file's columns
+        schema = pyarrow.unify_schemas([pyarrow.parquet.read_schema(path) for path in files])
+        dataset = pyarrow.dataset.dataset(files, schema=schema, format="parquet")
+        condition = None
+        if response_ids is not None:
+            condition = pyarrow.dataset.field(RESPONSE_ID_COLUMN).isin(list(response_ids))
+        for bound, test in ((start, lambda field, value: field >= value), (end, lambda field, value: field < value)):
+            if bound is not None:
+                clause = test(pyarrow.dataset.field(RECORDED_COLUMN), bound)
+                condition = clause if condition is None else condition & clause
+        value_columns = [name for name in schema.names if columns is None or name in columns]
+        read_columns = list(dict.fromkeys([RESPONSE_ID_COLUMN, RECORDED_COLUMN] + value_columns))
+        results = {}
+        # read file by file in that order (a dataset scan doesn't promise to keep it)
+        batches = (batch for fragment in dataset.get_fragments(filter=condition)
+                   for batch in fragment.to_batches(schema=schema, columns=read_columns, filter=condition))
+        for batch in batches:
+            for row in batch.to_pylist():
+                response_id = row[RESPONSE_ID_COLUMN]
+                if response_id in results:
+                    continue
+                results[response_id] = {
+                    "responseId": response_id,
+                    "recordedDate": row[RECORDED_COLUMN],
+                    "values": {name: row[name] for name in value_columns if row[name] is not None}
+                }
+        return list(results.values())
+
+    # responseId -> values for a survey's archived responses, e.g. to look up a validator's responses locally
+    def index(self, survey_id, response_ids=None, start=None, end=None, columns=None):
+        return {response['responseId']: response['values']
+                for response in self.query(survey_id, response_ids, start, end, columns)}
+
+    # the values of one archived response, or None if it isn't in the archive
+    def get(self, survey_id, response_id, columns=None):
+        found = self.query(survey_id, [response_id], columns=columns)
+        if len(found) == 0:
+            return None
+        return found[0]['values']
+
+# the date=YYYY-MM-DD partition a file is in
+def partition_date(path):
+    return os.path.basename(os.path.dirname(path)).split("=", 1)[1]
+
+# whether a date partition can hold responses recorded between start and end
+def in_date_range(date, start, end):
+    if start is not None and date < start[:10]:
+        return False
+    if end is not None and date > end[:10]:
+        return False
+    return True
@@ -0,0 +1,196 @@
+# Run instrumentation for the Qualtrics tools: per-endpoint call counts, latency histograms, bytes and retries
+# (recorded by sessions.RetrySession), time spent polling long-running jobs and per-stage wall time. Written out at
+# the end of a run as a JSON summary and a Prometheus textfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# prefix of every Prometheus metric name
+METRIC_PREFIX = "qualtrics_"
+
+_lock = threading.Lock()
+_endpoints = {}
+_polls = {}
+_stages = {}
+
+class EndpointStats:
+    """ running totals for one endpoint (method + templated path)
+
+    Attributes:
+        calls -- number of calls, by HTTP status code (0 for calls that never got a response)
+        seconds -- total latency of all calls
+        buckets -- number of calls at or under each LATENCY_BUCKETS bound (plus +Inf)
+        bytesSent -- total request body bytes
+        bytesReceived -- total response body bytes (as sent on the wire, i.e. compressed)
+        retries -- number of retried attempts
+    """
+    def __init__(self):
+        self.calls = {}
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.retries = 0
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+class TimerStats:
+    """ running totals for a named poll or stage timer
+
+    Attributes:
+        count -- number of timed runs
+        seconds -- total seconds across all runs
+        maxSeconds -- longest single run
+    """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.maxSeconds = max(self.maxSeconds, seconds)
+
+# turn a request URL into an endpoint name, replacing IDs (any path segment with a digit) so calls group together,
+# e.g. GET https://iad1.qualtrics.com/API/v3/surveys/SV_123/export-responses/ES_4 -> GET surveys/{id}/export-responses/{id}
+def endpoint_name(method, url):
+    path = urlparse(url).path
+    if "/API/v3/" in path:
+        path = path.split("/API/v3/", 1)[1]
+    segments = ["{id}" if re.search(r"\d", segment) else segment for segment in path.strip("/").split("/")]
+    return "{method} {path}".format(method=method.upper(), path="/".join(segments))
+
+# record one API call (including any retries it needed)
+def record_call(method, url, status, seconds, bytes_sent=0, bytes_received=0, retries=0):
+    name = endpoint_name(method, url)
+    with _lock:
+        stats = _endpoints.setdefault(name, EndpointStats())
+        stats.calls[status] = stats.calls.get(status, 0) + 1
+        stats.seconds += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                stats.buckets[i] += 1
+                break
+        else:
+            stats.buckets[-1] += 1
+        stats.bytesSent += bytes_sent
+        stats.bytesReceived += bytes_received
+        stats.retries += retries
+    return
+
+# record how long a job (export, import, ...) spent waiting on progress polls
+def record_poll(name, seconds):
+    with _lock:
+        _polls.setdefault(name, TimerStats()).add(seconds)
+    return
+
+# record the wall time of one run of a stage
+def record_stage(name, seconds):
+    with _lock:
+        _stages.setdefault(name, TimerStats()).add(seconds)
+    return
+
+# context manager timing the wrapped block as a stage, e.g. with metrics.stage("runner:download_qsf"):
+@contextmanager
+def stage(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_stage(name, time.monotonic() - start)
+
+# forget everything recorded so far (e.g. between benchmark runs)
+def reset():
+    with _lock:
+        _endpoints.clear()
+        _polls.clear()
+        _stages.clear()
+    return
+
+# everything recorded so far as a JSON-serializable dict
+def summary():
+    with _lock:
+        endpoints = {}
+        for name, stats in sorted(_endpoints.items()):
+            total_calls = stats.total_calls()
+            endpoints[name] = {
+                "calls": total_calls,
+                "statusCodes": {str(code): count for code, count in sorted(stats.calls.items())},
+                "totalSeconds": round(stats.seconds, 4),
+                "meanSeconds": round(stats.seconds / total_calls, 4) if total_calls else 0,
+                "latencyBuckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], stats.buckets)),
+                "bytesSent": stats.bytesSent,
+                "bytesReceived": stats.bytesReceived,
+                "retries": stats.retries
+            }
+        timers = {}
+        for label, group in (("polling", _polls), ("stages", _stages)):
+            timers[label] = {name: {"count": stats.count, "totalSeconds": round(stats.seconds, 4),
+                                    "maxSeconds": round(stats.maxSeconds, 4)}
+                             for name, stats in sorted(group.items())}
+    return {"endpoints": endpoints, "polling": timers["polling"], "stages": timers["stages"]}
+
+# escape a label value for the Prometheus text format
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# everything recorded so far in the Prometheus text exposition format (for the node_exporter textfile collector)
+def prometheus_text():
+    lines = []
+    def metric(name, metric_type, help_text):
+        lines.append("# HELP {prefix}{name} {help}".format(prefix=METRIC_PREFIX, name=name, help=help_text))
+        lines.append("# TYPE {prefix}{name} {type}".format(prefix=METRIC_PREFIX, name=name, type=metric_type))
+    def sample(name, labels, value):
+        label_text = ",".join('{key}="{value}"'.format(key=key, value=prometheus_label(val)) for key, val in labels)
+        lines.append("{prefix}{name}{{{labels}}} {value}".format(prefix=METRIC_PREFIX, name=name, labels=label_text,
+                                                                  value=value))
+
+    with _lock:
+        endpoints = sorted(_endpoints.items())
+        metric("api_requests_total", "counter", "Qualtrics API calls by endpoint and HTTP status")
+        for name, stats in endpoints:
+            for code, count in sorted(stats.calls.items()):
+                sample("api_requests_total", [("endpoint", name), ("status", code)], count)
+        metric("api_request_seconds", "histogram", "Qualtrics API call latency, including retries")
+        for name, stats in endpoints:
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], stats.buckets):
+                cumulative += count
+                sample("api_request_seconds_bucket", [("endpoint", name), ("le", bound)], cumulative)
+            sample("api_request_seconds_sum", [("endpoint", name)], round(stats.seconds, 6))
+            sample("api_request_seconds_count", [("endpoint", name)], stats.total_calls())
+        for metric_name, attribute, help_text in (("api_bytes_sent_total", "bytesSent", "Request body bytes"),
+                                                  ("api_bytes_received_total", "bytesReceived", "Response body bytes"),
+                                                  ("api_retries_total", "retries", "Retried API call attempts")):
+            metric(metric_name, "counter", help_text)
+            for name, stats in endpoints:
+                sample(metric_name, [("endpoint", name)], getattr(stats, attribute))
+        for label, group, help_text in (("poll", _polls, "Seconds spent waiting on progress polls"),
+                                        ("stage", _stages, "Wall time of pipeline stages")):
+            metric(label + "_seconds_total", "counter", help_text)
+            for name, stats in sorted(group.items()):
+                sample(label + "_seconds_total", [(label, name)], round(stats.seconds, 6))
+            metric(label + "_runs_total", "counter", "Number of timed runs")
+            for name, stats in sorted(group.items()):
+                sample(label + "_runs_total", [(label, name)], stats.count)
+    return "\n".join(lines) + "\n"
+
+# write the JSON summary and the Prometheus textfile for the run into the given directory
+def write_summary(directory, name):
+    json_path = os.path.join(directory, name + "_metrics.json")
+    with open(json_path, "w") as json_file:
+        json.dump(summary(), json_file, indent=4)
+    # write then rename so the textfile collector never reads a half-written file
+    prom_path = os.path.join(directory, name + ".prom")
+    with open(prom_path + ".tmp", "w") as prom_file:
+        prom_file.write(prometheus_text())
+    os.replace(prom_path + ".tmp", prom_path)
+    return json_path, prom_path
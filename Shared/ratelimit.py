@@ -0,0 +1,108 @@
+# Shared rate limiting for the Qualtrics tools. One token bucket per (data center, API token) pair, so every thread
+# or task calling the same brand shares the same budget. Usable from threads (acquire) and asyncio (acquire_async),
+# and adaptive: a 429 cuts the rate (and pauses for Retry-After), successes slowly raise it back
+import asyncio
+import threading
+import time
+
+# default requests/sec and burst size for a new bucket: Qualtrics' brand-wide limit of 3000 calls a minute, so the
+# bucket only paces a run that would otherwise be throttled. Set a brand's own limit with set_limit
+DEFAULT_RATE = 50.0
+DEFAULT_BURST = 50
+# on a 429 the rate is multiplied by DECREASE_FACTOR (never below MIN_RATE), each success adds INCREASE_STEP back
+DECREASE_FACTOR = 0.5
+MIN_RATE = 0.5
+INCREASE_STEP = 0.1
+
+_limiters = {}
+_limits = {}
+_limiters_lock = threading.Lock()
+
+class TokenBucket:
+    """ token bucket limiting calls to a rate, allowing short bursts
+
+    Attributes:
+        maxRate -- configured requests/sec, the rate recovers back up to this
+        rate -- current requests/sec (lowered after 429s)
+        burst -- most tokens the bucket holds, i.e. calls allowed back to back after an idle spell
+        tokens -- tokens available now (negative when callers have reserved future tokens)
+        pausedUntil -- monotonic time before which no call may start (from a Retry-After)
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self.maxRate = float(rate)
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.pausedUntil = 0.0
+        self.lock = threading.Lock()
+
+    # take a token, returning how many seconds the caller must wait before making its call
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.pausedUntil - now)
+
+    # block the calling thread until a call is allowed
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        return
+
+    # wait (without blocking the event loop) until a call is allowed
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return
+
+    # the server throttled us: slow down, and stop entirely for retry_after seconds if it said how long
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self.rate = max(MIN_RATE, self.rate * DECREASE_FACTOR)
+            if retry_after:
+                self.pausedUntil = max(self.pausedUntil, time.monotonic() + retry_after)
+        return
+
+    # a call went through without throttling, creep back towards the configured rate
+    def succeeded(self):
+        if self.rate < self.maxRate:
+            with self.lock:
+                self.rate = min(self.maxRate, self.rate + INCREASE_STEP)
+        return
+
+# change the defaults for buckets created after the call
+def configure(rate=None, burst=None):
+    global DEFAULT_RATE, DEFAULT_BURST
+    if rate is not None:
+        DEFAULT_RATE = rate
+    if burst is not None:
+        DEFAULT_BURST = burst
+    return
+
+# set the rate/burst for one data center (and optionally one API token), e.g. a brand with a raised API limit.
+# Setting the limit it already has keeps the bucket, along with its tokens and any 429 backoff
+def set_limit(dc, rate, burst=None, token=None):
+    limit = (rate, burst if burst is not None else max(1, int(rate)))
+    with _limiters_lock:
+        if _limits.get((dc, token)) == limit:
+            return
+        _limits[(dc, token)] = limit
+        _limiters.pop((dc, token), None)
+    return
+
+# get (or create) the shared bucket for a data center + API token
+def get_limiter(dc, token=None):
+    key = (dc, token)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            rate, burst = _limits.get(key) or _limits.get((dc, None)) or (DEFAULT_RATE, DEFAULT_BURST)
+            limiter = TokenBucket(rate, burst)
+            _limiters[key] = limiter
+    return limiter
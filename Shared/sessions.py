@@ -0,0 +1,208 @@
+# Shared HTTP layer for the Qualtrics tools. Keeps one pooled requests.Session per data center so thousands of
+# small API calls reuse the same keep-alive connections, and retries throttled/transient failures with backoff
+import os
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+import metrics
+import ratelimit
+
+# connection pool size per data center (should be at least the number of threads sharing the session)
+POOL_SIZE = 20
+# number of times a failed call is retried before the last response/error is handed back to the caller
+MAX_RETRIES = 5
+# base and cap (seconds) for the exponential backoff between retries
+BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60
+# statuses worth retrying for any request, and the subset that is safe to retry for a POST (the server did no work)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_POST_STATUSES = (429, 503)
+# seconds to wait for a connection, and between bytes of a response (longer for streamed downloads, which can pause
+# while a large file is read), unless the call passes its own timeout
+CONNECT_TIMEOUT_SECONDS = 10
+READ_TIMEOUT_SECONDS = 60
+STREAM_READ_TIMEOUT_SECONDS = 300
+
+# send every call to this base URL instead of https://{dc}.qualtrics.com (e.g. a local mock server for benchmarks)
+BASE_URL_OVERRIDE = os.environ.get("QUALTRICS_BASE_URL")
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# change the pool/retry/timeout settings (pool size only affects sessions created after the call)
+def configure(pool_size=None, max_retries=None, backoff_seconds=None, max_backoff_seconds=None, base_url=None,
+              connect_timeout=None, read_timeout=None, stream_read_timeout=None):
+    global POOL_SIZE, MAX_RETRIES, BACKOFF_SECONDS, MAX_BACKOFF_SECONDS, BASE_URL_OVERRIDE
+    global CONNECT_TIMEOUT_SECONDS, READ_TIMEOUT_SECONDS, STREAM_READ_TIMEOUT_SECONDS
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if max_retries is not None:
+        MAX_RETRIES = max_retries
+    if backoff_seconds is not None:
+        BACKOFF_SECONDS = backoff_seconds
+    if max_backoff_seconds is not None:
+        MAX_BACKOFF_SECONDS = max_backoff_seconds
+    if base_url is not None:
+        BASE_URL_OVERRIDE = base_url
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT_SECONDS = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT_SECONDS = read_timeout
+    if stream_read_timeout is not None:
+        STREAM_READ_TIMEOUT_SECONDS = stream_read_timeout
+    return
+
+# point a https://{dc}.qualtrics.com URL at BASE_URL_OVERRIDE, if one is set
+def resolve_url(url):
+    if not BASE_URL_OVERRIDE:
+        return url
+    return re.sub(r"^https://[^/]+\.qualtrics\.com", BASE_URL_OVERRIDE.rstrip("/"), url)
+
+# exponential backoff with full jitter, so threads that were throttled together don't retry together
+def backoff_delay(attempt):
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * (2 ** attempt)))
+
+# seconds the server asked us to wait, from a Retry-After header in either seconds or HTTP-date form
+def retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_date - datetime.now(timezone.utc)).total_seconds())
+
+# whether a connection error happened before the request was sent (no connection could be made), so the server
+# can't have acted on it. A connection dropped after sending (e.g. a stale keep-alive) could have been acted on
+def failed_to_connect(err):
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = err.args[0] if err.args else None
+    # requests wraps urllib3's MaxRetryError, which holds the underlying error as its reason
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+# whether a POST that still failed after its retries can be sent again without risking a duplicate: the server
+# turned it away without acting on it (a 429/503, err being the HTTPError from raise_for_status), or no connection
+# could be made
+def post_can_resend(err):
+    if isinstance(err, requests.exceptions.HTTPError):
+        return err.response is not None and err.response.status_code in RETRY_POST_STATUSES
+    return isinstance(err, requests.exceptions.RequestException) and failed_to_connect(err)
+
+# rewind any file bodies (data=open(...), files={...: (name, open(...))}) so a retried request resends them in full
+def rewind_body(kwargs):
+    bodies = [kwargs.get("data")]
+    for value in (kwargs.get("files") or {}).values():
+        bodies.append(value[1] if isinstance(value, tuple) else value)
+    for body in bodies:
+        if hasattr(body, "seek"):
+            body.seek(0)
+    return
+
+# size in bytes of a prepared request's body (streamed bodies only report what their Content-Length says)
+def request_bytes(prepared_request):
+    body = prepared_request.body
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    return int(prepared_request.headers.get("Content-Length") or 0)
+
+# size in bytes of a response body, as sent on the wire when the server gave a Content-Length. A streamed response
+# without one isn't read here, so its body isn't counted
+def response_bytes(response, stream):
+    length = response.headers.get("Content-Length")
+    if length is not None:
+        return int(length)
+    if stream:
+        return 0
+    return len(response.content)
+
+class RetrySession(requests.Session):
+    """ requests.Session that retries throttled (429) and transient (5xx/connection/timeout) failures. A POST is only
+    retried when the server did no work: a 429/503, or a connection that couldn't be made. Calls without their own
+    timeout get the module's (connect, read) timeouts, so a stalled connection can't hang a worker
+
+    Attributes:
+        dc -- data center the session's calls go to, used to pick the shared rate limiter
+
+    Methods:
+        request -- overwriting default request method to wait on the (dc, API token) rate limiter, add retries with
+                   jittered backoff honoring Retry-After, and record the call (latency including retries, bytes,
+                   retry count) with metrics
+    """
+    def __init__(self, dc=None):
+        super().__init__()
+        self.dc = dc
+
+    def request(self, method, url, **kwargs):
+        url = resolve_url(url)
+        kwargs.setdefault("timeout", (CONNECT_TIMEOUT_SECONDS,
+                                      STREAM_READ_TIMEOUT_SECONDS if kwargs.get("stream") else READ_TIMEOUT_SECONDS))
+        retry_statuses = RETRY_POST_STATUSES if method.upper() == "POST" else RETRY_STATUSES
+        limiter = ratelimit.get_limiter(self.dc, (kwargs.get("headers") or {}).get("X-API-TOKEN"))
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            limiter.acquire()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                # a POST that may have reached the server isn't resent, it could create a duplicate survey/import
+                if attempt >= MAX_RETRIES or (method.upper() == "POST" and not failed_to_connect(err)):
+                    metrics.record_call(method, url, 0, time.monotonic() - start, retries=attempt)
+                    raise
+                delay = backoff_delay(attempt)
+            else:
+                if response.status_code == 429:
+                    limiter.throttled(retry_after_seconds(response))
+                else:
+                    limiter.succeeded()
+                if response.status_code not in retry_statuses or attempt >= MAX_RETRIES:
+                    metrics.record_call(method, url, response.status_code, time.monotonic() - start,
+                                        request_bytes(response.request),
+                                        response_bytes(response, kwargs.get("stream", False)), attempt)
+                    return response
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                response.close()
+            print("Retrying {method} {url} in {delay:.1f}s (attempt {n})".format(
+                method=method, url=url, delay=delay, n=attempt + 1))
+            attempt += 1
+            time.sleep(delay)
+            rewind_body(kwargs)
+
+# get (or create) the shared session for a data center
+def get_session(dc):
+    with _sessions_lock:
+        session = _sessions.get(dc)
+        if session is None:
+            session = RetrySession(dc)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive"
+            })
+            _sessions[dc] = session
+    return session
+
+# close every pooled connection, e.g. at the end of a run
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+    return